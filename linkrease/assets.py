@@ -0,0 +1,63 @@
+#This file is part of linkrease.
+
+#linkrease is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#linkrease is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+import settings
+
+ASSET_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Assets(object):
+    """
+    Game images, loaded on first use and packed into one texture atlas.
+
+    Nothing is read from disk and no GL context is needed until an image is
+    first asked for. All images then share one texture, so sprites of every
+    type can be drawn from the same batch without texture switches.
+    """
+    def __init__(self, files, size=64):
+        """
+        files: dict of name -> filename in ASSET_DIR
+        size: starting atlas width and height, doubled until all images fit
+        """
+        self._files = files
+        self._size = size
+        self._regions = None
+
+    def _load(self):
+        from pyglet import image
+        from pyglet.image.atlas import AllocatorException, TextureAtlas
+
+        images = [(name, image.load(os.path.join(ASSET_DIR, filename)))
+                  for name, filename in sorted(self._files.items())]
+        #pack the largest images first
+        images.sort(key=lambda item: -item[1].width * item[1].height)
+        size = self._size
+        while True:
+            atlas = TextureAtlas(size, size)
+            try:
+                self._regions = dict([(name, atlas.add(img)) for name, img in images])
+                return
+            except AllocatorException:
+                size *= 2
+
+    def __getitem__(self, name):
+        if self._regions is None:
+            self._load()
+        return self._regions[name]
+
+
+IMAGE_DATA = Assets(settings.IMAGE_FILES)
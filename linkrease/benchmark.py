@@ -0,0 +1,230 @@
+#This file is part of linkrease.
+
+#linkrease is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#linkrease is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks the model hot paths over a range of map sizes and fleet counts.
+
+Runs headless. Each map size is measured in its own process so the peak
+memory reported belongs to that size alone. Results are written as JSON.
+
+usage: python benchmark.py [--nodes 100,1000] [--fleets 1,100] [--output FILE]
+"""
+
+import argparse
+import json
+import multiprocessing
+import random
+import resource
+import sys
+import time
+from math import pi, sqrt
+
+import levels
+import models
+import routing
+import settings
+
+NODE_COUNTS = [100, 500, 1000, 5000, 10000, 20000]
+FLEET_COUNTS = [1, 10, 100, 1000, 10000]
+PERCENTILES = [50, 90, 99]
+
+#nodes fleets are sent to, as players pick a few targets at a time
+FLEET_TARGETS = 16
+
+
+def level_params(nodes):
+    """
+    Returns (radius, repel) giving a connected level with about eight
+    links per node, for any number of nodes.
+    """
+    radius = sqrt(8.0 / (pi * nodes))
+    repel = 0.3 / sqrt(nodes)
+    return radius, repel
+
+
+def summarise(samples):
+    """
+    Returns latency statistics, in seconds, of a list of timings.
+    """
+    samples = sorted(samples)
+    last = len(samples) - 1
+    stats = dict([('p%d' % p, samples[int(round(last * p / 100.0))])
+                  for p in PERCENTILES])
+    stats['min'] = samples[0]
+    stats['max'] = samples[-1]
+    stats['mean'] = sum(samples) / len(samples)
+    stats['samples'] = len(samples)
+    return stats
+
+
+def measure(func, repeat, setup=None):
+    """
+    Times repeat calls of func, calling setup untimed before each one.
+    setup's return value is passed to func.
+    """
+    samples = []
+    for r in xrange(repeat):
+        args = setup() if setup else ()
+        start = time.time()
+        func(*args)
+        samples.append(time.time() - start)
+    return summarise(samples)
+
+
+def peak_memory():
+    """
+    Returns the peak resident memory of this process in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def launch_fleets(map, count, targets, rand):
+    """
+    Launches fleets from random nodes to random nodes of targets, once for
+    each fleet short of count in flight. Fleets that merge on launch are
+    not made up for.
+
+    Launches go straight to the FleetEngine, so no route is highlighted.
+    """
+    engine = map.get_fleet_engine()
+    player = settings.PLAYER[1]
+    nodes = map.number_of_nodes()
+    for f in xrange(count - len(engine)):
+        source = rand.randrange(nodes)
+        target = rand.choice(targets)
+        if source != target:
+            engine.launch(1, player, source, target)
+
+
+def bench_advance(graph, count, targets, repeat, rand):
+    """
+    Times whole ticks with count fleets in flight to targets, replacing
+    fleets that arrived before the next tick.
+    """
+    map = models.Map(graph)
+    in_flight = []
+
+    def top_up():
+        launch_fleets(map, count, targets, rand)
+        in_flight.append(len(map.get_fleet_engine()))
+        return ()
+    stats = measure(lambda: map.advance(settings.HEADLESS_STEP), repeat, top_up)
+    stats['in_flight'] = summarise(in_flight)
+    stats['targets'] = len(targets)
+    return stats
+
+
+def bench_nodes(nodes, fleet_counts, repeat, seed):
+    """
+    Measures every operation on a map of the given size.
+    """
+    rand = random.Random(seed)
+    radius, repel = level_params(nodes)
+    ops = {}
+
+    start = time.time()
+    map = levels.generate_random_level(nodes=nodes, radius=radius, repel=repel, seed=seed)
+    ops['generate_random_level'] = summarise([time.time() - start])
+
+    graph = map.to_networkx()
+    ops['map_init'] = measure(lambda: models.Map(graph), max(1, repeat // 10))
+
+    pair = lambda: (rand.randrange(nodes), rand.randrange(nodes))
+
+    def cold_pair():
+        map._routing.clear()
+        return pair()
+
+    def warm_pair():
+        source, target = pair()
+        map.precompute_routes(sources=[source])
+        return (source, target)
+    ops['shortest_path_cold'] = measure(map.shortest_path, repeat, cold_pair)
+    ops['shortest_path_warm'] = measure(map.shortest_path, repeat, warm_pair)
+
+    player = settings.PLAYER[1]
+
+    def select():
+        source, target = pair()
+        map.select_node(player, source, set_target=False)
+        return (player, target)
+    ops['highlight_route'] = measure(map.target_node, repeat, select)
+    map.select_node(player, None)
+
+    point = lambda: (rand.random(), rand.random())
+    ops['closest_node_to'] = measure(map.closest_node_to, repeat, point)
+
+    targets = [rand.randrange(nodes) for t in xrange(FLEET_TARGETS)]
+    fleets = dict([(str(count), bench_advance(graph, count, targets, repeat, rand))
+                   for count in fleet_counts])
+
+    #more targets in flight than idle flow fields are kept for
+    idle_fields = routing.FLOW_FIELD_NODES // nodes
+    spread = rand.sample(xrange(nodes), min(nodes, idle_fields + FLEET_TARGETS))
+    count = max(fleet_counts)
+    ops['advance_spread'] = bench_advance(graph, count, spread, repeat, rand)
+
+    return {
+        'nodes': nodes,
+        'edges': graph.number_of_edges(),
+        'operations': ops,
+        'advance': fleets,
+        'peak_memory': peak_memory(),
+    }
+
+
+def _run_in_child(queue, args):
+    queue.put(bench_nodes(*args))
+
+
+def run(node_counts, fleet_counts, repeat=100, seed=0):
+    """
+    Benchmarks each map size in a fresh process and returns the results.
+    """
+    results = []
+    for nodes in node_counts:
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(
+            target=_run_in_child,
+            args=(queue, (nodes, fleet_counts, repeat, seed)))
+        child.start()
+        results.append(queue.get())
+        child.join()
+    return {
+        'repeat': repeat,
+        'seed': seed,
+        'percentiles': PERCENTILES,
+        'results': results,
+    }
+
+
+def main(argv):
+    counts = lambda text: [int(c) for c in text.split(',')]
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--nodes', type=counts, default=NODE_COUNTS)
+    parser.add_argument('--fleets', type=counts, default=FLEET_COUNTS)
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout)
+    args = parser.parse_args(argv[1:])
+
+    report = run(args.nodes, args.fleets, args.repeat, args.seed)
+    json.dump(report, args.output, indent=1, sort_keys=True)
+    args.output.write('\n')
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,133 @@
+#This file is part of linkrease.
+
+#linkrease is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#linkrease is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Checks that repaired shortest path trees match ones grown from scratch.
+
+Toggles random creases on a generated map, repairing a tree per root as
+the map does, and after every toggle compares each with a fresh grow()
+and with networkx. The map's own routing rows and flow fields are checked
+against the repaired trees. Exits non-zero if anything differs.
+
+usage: python check_routing.py [toggles] [nodes] [roots] [seed]
+"""
+
+import random
+
+import networkx as nx
+
+import levels
+import routing
+
+#relative error allowed between lengths summed in a different order
+TOLERANCE = 1e-9
+
+
+def close(a, b):
+    if a == b:
+        return True
+    return abs(a - b) <= TOLERANCE * max(1.0, abs(a), abs(b))
+
+
+def compare(map, tree, fresh, lengths):
+    """
+    Returns a description of every way tree differs from fresh, a tree
+    grown from the same root, and from lengths, networkx's distances.
+
+    Where two paths are equally short the trees may pick either, so a
+    different parent is allowed if it is on a shortest path and first
+    agrees with it.
+    """
+    root = tree.root
+    problems = []
+    for n in xrange(map.number_of_nodes()):
+        d = tree.dist[n]
+        if not close(d, fresh.dist[n]):
+            problems.append('dist[%d] %r, grown %r' % (n, d, fresh.dist[n]))
+        if not close(d, lengths.get(n, routing.INFINITY)):
+            problems.append('dist[%d] %r, networkx %r' % (n, d, lengths.get(n)))
+        p = tree.parent[n]
+        if p == fresh.parent[n] and tree.first[n] == fresh.first[n]:
+            continue
+        if p == routing.NO_NODE or fresh.parent[n] == routing.NO_NODE:
+            problems.append('parent[%d] %d, grown %d' % (n, p, fresh.parent[n]))
+        elif not close(tree.dist[p] + map.get_weight(p, n), d):
+            problems.append('parent[%d] %d is not on a shortest path' % (n, p))
+        elif tree.first[n] != (n if p == root else tree.first[p]):
+            problems.append('first[%d] %d, expected %d' % (
+                n, tree.first[n], n if p == root else tree.first[p]))
+    return problems
+
+
+def check_map(map, tree):
+    """
+    Returns a description of every way the routing row and flow field the
+    map holds for the root of tree disagree with it.
+    """
+    root = tree.root
+    problems = []
+    for n in xrange(map.number_of_nodes()):
+        path = map.shortest_path(root, n)
+        if path != tree.path_to(n):
+            problems.append('routing row %d->%d %r, tree %r' % (root, n, path, tree.path_to(n)))
+        hop = map.next_hop(n, root)
+        expected = None if tree.parent[n] == routing.NO_NODE else tree.parent[n]
+        if hop != expected:
+            problems.append('flow field %d->%d next hop %r, tree %r' % (n, root, hop, expected))
+    return problems
+
+
+def main(argv):
+    toggles = int(argv[1]) if len(argv) > 1 else 200
+    nodes = int(argv[2]) if len(argv) > 2 else 180
+    roots = int(argv[3]) if len(argv) > 3 else 4
+    seed = int(argv[4]) if len(argv) > 4 else 0
+
+    rand = random.Random(seed)
+    map = levels.generate_random_level(nodes=nodes, seed=seed)
+    size = map.number_of_nodes()
+    edges = list(map.edges_iter())
+    roots = rand.sample(xrange(size), min(roots, size))
+    trees = [routing.ShortestPathTree(root, size).grow(map.neighbours) for root in roots]
+    map.precompute_routes(roots)
+    for root in roots:
+        map.next_hop(root, root)
+
+    failures = 0
+    for t in xrange(toggles):
+        n1, n2 = rand.choice(edges)
+        old_weight = map.get_weight(n1, n2)
+        map.set_creased(n1, n2, not map.get_creased(n1, n2), no_event=True)
+        new_weight = map.get_weight(n1, n2)
+        for tree in trees:
+            if tree.affected_by(n1, n2, old_weight, new_weight):
+                tree.repair(n1, n2, old_weight, new_weight, map.neighbours)
+
+        G = map.to_networkx()
+        for tree in trees:
+            fresh = routing.ShortestPathTree(tree.root, size).grow(map.neighbours)
+            lengths = nx.single_source_dijkstra_path_length(G, tree.root)
+            problems = compare(map, tree, fresh, lengths) + check_map(map, tree)
+            for problem in problems:
+                print('toggle %d (%d-%d), root %d: %s' % (t, n1, n2, tree.root, problem))
+            failures += len(problems)
+
+    print('%d toggles, %d roots, %d nodes: %d mismatches' % (toggles, len(roots), size, failures))
+    return min(failures, 255)
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main(sys.argv))
@@ -0,0 +1,470 @@
+#This file is part of linkrease.
+
+#linkrease is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#linkrease is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
+
+from heapq import heapify, heappop, heappush
+
+import numpy as np
+
+import settings
+
+#rows kept in state(), each in an array named with a leading underscore
+STATE = ('source', 'next', 'dist', 'jump', 'speed',
+         'owner', 'target', 'units', 'alive')
+
+
+class FleetEngine(object):
+    """
+    Keeps every fleet in flight as one row of a set of flat arrays, and
+    moves all of them in a single step() call.
+
+    Each row holds the node the fleet last left (source), the node it is
+    heading to (next), the distance travelled since source, the length of
+    the current edge, the speed on that edge, and its owner, target and
+    unit count. Rows of arrived fleets are reused by later launches.
+
+    A fleet entering an edge within merge_distance of another fleet with
+    the same owner and target on that edge joins it, adding its units. The
+    next hop depends only on the node and the target, so fleets merged this
+    way never need to split again.
+    """
+    def __init__(self, map, capacity=64, merge_distance=settings.FLEET_MERGE_DISTANCE):
+        self._map = map
+        self._size = 0
+        self._free = []
+        self._merge_distance = merge_distance
+
+        #rows by (owner, source, next, target)
+        self._groups = {}
+
+        #Fleet views of live rows, made when first asked for (see _view)
+        self._fleets = {}
+
+        #live rows by target, so routes still in use are kept (see in_flight)
+        self._heading = {}
+
+        #rows changed other than by moving along their edge (see touched)
+        self._touched = set()
+
+        #node positions, indexed by node
+        self._xy = np.array(map.get_positions(), dtype=np.float64).reshape(-1, 2)
+
+        self._source = np.zeros(capacity, dtype=np.int32)
+        self._next = np.zeros(capacity, dtype=np.int32)
+        self._dist = np.zeros(capacity, dtype=np.float64)
+        self._jump = np.ones(capacity, dtype=np.float64)
+        self._speed = np.zeros(capacity, dtype=np.float64)
+        self._owner = np.zeros(capacity, dtype=np.int32)
+        self._target = np.zeros(capacity, dtype=np.int32)
+        self._units = np.zeros(capacity, dtype=np.int32)
+        self._alive = np.zeros(capacity, dtype=np.bool_)
+
+        #positions at the previous tick, and how far rendering is from there
+        #to the current tick (see save_positions)
+        self._prev = np.zeros((capacity, 2), dtype=np.float64)
+        self.alpha = 1.0
+
+    def _grow(self):
+        capacity = len(self._alive) * 2
+        for name in ['_' + name for name in STATE] + ['_prev']:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        self._jump[self._size:] = 1.0
+
+    def _key(self, slot):
+        return (int(self._owner[slot]), int(self._source[slot]),
+                int(self._next[slot]), int(self._target[slot]))
+
+    def _view(self, slot):
+        """
+        Returns the Fleet view of a live row, making it if there is none.
+        """
+        fleet = self._fleets.get(slot)
+        if fleet is None:
+            fleet = Fleet(self, slot, int(self._units[slot]),
+                          settings.PLAYER[self._owner[slot]], int(self._target[slot]))
+            self._fleets[slot] = fleet
+        return fleet
+
+    def _head_for(self, target, rows):
+        count = self._heading.get(target, 0) + rows
+        if count:
+            self._heading[target] = count
+        else:
+            del self._heading[target]
+
+    def in_flight(self, target):
+        """
+        Returns how many rows are live with target as their target.
+        """
+        return self._heading.get(target, 0)
+
+    def _leave_group(self, slot):
+        key = self._key(slot)
+        group = self._groups[key]
+        group.remove(slot)
+        if not group:
+            del self._groups[key]
+
+    def _enter_edge(self, slot, source, next):
+        """
+        Puts a row at the start of the edge from source to next.
+
+        pre: owner and target of the row are set
+        """
+        if self._alive[slot]:
+            self._leave_group(slot)
+        self._source[slot] = source
+        self._next[slot] = next
+        self._dist[slot] = 0.0
+        self._jump[slot] = self._map.get_weight(source, next)
+        self._speed[slot] = settings.UNIT_SPEED[self._map.get_type(source, next)]
+        self._groups.setdefault(self._key(slot), []).append(slot)
+        self._touched.add(slot)
+
+    def _merge(self, slot):
+        """
+        Adds a row to a fleet close to it on the same edge, if there is
+        one, and frees the row.
+
+        Returns the row now carrying its units.
+        """
+        dist = self._dist
+        close = [other for other in self._groups[self._key(slot)]
+                 if other != slot and abs(dist[other] - dist[slot]) <= self._merge_distance]
+        if not close:
+            return slot
+        #lowest row first, so restoring state() gives the same merges
+        other = min(close)
+        self._units[other] += self._units[slot]
+        self._touched.add(other)
+        into = self._view(other)
+        into._units = int(self._units[other])
+        self._release(slot)._merge(into)
+        return other
+
+    def launch(self, units, player, source, target):
+        """
+        Adds a fleet leaving source for target and returns its Fleet view.
+
+        If the fleet joins another straight away, the view returned is
+        already merged (see Fleet.get_merged_into).
+
+        pre: source is not target
+        """
+        if self._free:
+            slot = heappop(self._free)
+        else:
+            if self._size == len(self._alive):
+                self._grow()
+            slot = self._size
+            self._size += 1
+
+        self._owner[slot] = settings.PLAYER.index(player)
+        self._target[slot] = target
+        self._units[slot] = units
+        self._head_for(target, 1)
+        self._enter_edge(slot, source, self._map.next_hop(source, target))
+        self._prev[slot] = self._xy[source]
+        self._alive[slot] = True
+
+        fleet = Fleet(self, slot, units, player, target)
+        self._fleets[slot] = fleet
+        self._merge(slot)
+        return fleet
+
+    def _release(self, slot):
+        fleet = self._view(slot)
+        del self._fleets[slot]
+        self._leave_group(slot)
+        self._head_for(int(self._target[slot]), -1)
+        self._touched.add(slot)
+        self._alive[slot] = False
+        self._dist[slot] = 0.0
+        self._speed[slot] = 0.0
+        self._jump[slot] = 1.0
+        heappush(self._free, slot)
+        return fleet
+
+    def step(self, dt):
+        """
+        Moves every fleet forward by dt seconds.
+
+        Returns the list of fleets that reached their target; their rows
+        are freed. Fleets that reach a new edge close to another may merge.
+        """
+        size = self._size
+        dist = self._dist[:size]
+        dist += self._speed[:size] * dt
+
+        arrived = []
+        crossed = np.flatnonzero(dist >= self._jump[:size])
+        for slot in crossed:
+            #time left over after reaching the end of the edge
+            spare = (self._dist[slot] - self._jump[slot]) / self._speed[slot]
+            target = int(self._target[slot])
+            while True:
+                source = int(self._next[slot])
+                hop = self._map.next_hop(source, target)
+                if hop is None:  # on last node
+                    arrived.append(self._release(slot))
+                    break
+                self._enter_edge(slot, source, hop)
+                self._dist[slot] = spare * self._speed[slot]
+                if self._dist[slot] < self._jump[slot]:
+                    self._merge(slot)
+                    break
+                spare = (self._dist[slot] - self._jump[slot]) / self._speed[slot]
+        return arrived
+
+    def edge_changed(self, n1, n2):
+        """
+        Rescales fleets on edge n1-n2 after its weight or type changed,
+        keeping the fraction of the edge they have covered.
+        """
+        size = self._size
+        source = self._source[:size]
+        next = self._next[:size]
+        on_edge = self._alive[:size] & (((source == n1) & (next == n2)) |
+                                        ((source == n2) & (next == n1)))
+        if not on_edge.any():
+            return
+        weight = self._map.get_weight(n1, n2)
+        speed = settings.UNIT_SPEED[self._map.get_type(n1, n2)]
+        slots = np.flatnonzero(on_edge)
+        self._dist[slots] *= weight / self._jump[slots]
+        self._jump[slots] = weight
+        self._speed[slots] = speed
+        self._touched.update(slots.tolist())
+
+    def fleets(self):
+        return [self._view(slot) for slot in np.flatnonzero(self._alive[:self._size]).tolist()]
+
+    def __len__(self):
+        return self._size - len(self._free)
+
+    def _current(self, slots):
+        xy = self._xy
+        source = xy[self._source[slots]]
+        ratio_complete = self._dist[slots] / self._jump[slots]
+        return source + (xy[self._next[slots]] - source) * ratio_complete[..., None]
+
+    def save_positions(self):
+        """
+        Remembers where every fleet is, before a tick moves them.
+
+        Positions are then given alpha of the way from there to where the
+        fleets are now, so rendering can fall between ticks.
+        """
+        slots = np.flatnonzero(self._alive[:self._size])
+        self._prev[slots] = self._current(slots)
+
+    def _interpolated(self, slots):
+        xy = self._current(slots)
+        if self.alpha < 1.0:
+            prev = self._prev[slots]
+            xy = prev + (xy - prev) * self.alpha
+        return xy
+
+    def position(self, slot):
+        x, y = self._interpolated(slot)
+        return (float(x), float(y))
+
+    def positions(self):
+        """
+        Returns (slots, xy): the rows of live fleets and an array of their
+        positions in map space, one (x, y) row per fleet.
+        """
+        slots = np.flatnonzero(self._alive[:self._size])
+        return slots, self._interpolated(slots)
+
+    def state(self):
+        """
+        Returns a dict of name -> NumPy array holding every row, so that
+        restore() can rebuild the engine.
+        """
+        size = self._size
+        state = dict([(name, getattr(self, '_' + name)[:size]) for name in STATE])
+        state['prev'] = self._prev[:size]
+        return state
+
+    def restore(self, state):
+        """
+        Replaces every fleet with those of a state() dict. Views of the old
+        fleets arrive, and views of the new rows are only made when asked
+        for.
+        """
+        for fleet in self._fleets.values():
+            fleet._arrive()
+        size = len(state['alive'])
+        capacity = max(64, size)
+        for name in STATE:
+            values = np.zeros(capacity, dtype=getattr(self, '_' + name).dtype)
+            values[:size] = state[name]
+            setattr(self, '_' + name, values)
+        self._jump[size:] = 1.0
+        self._prev = np.zeros((capacity, 2), dtype=np.float64)
+        self._prev[:size] = np.asarray(state['prev']).reshape(-1, 2)
+        self._size = size
+        alive = self._alive[:size]
+        #ascending, so already a heap
+        self._free = np.flatnonzero(~alive).tolist()
+        self._fleets = {}
+        self._groups = {}
+        self._touched = set(xrange(size))
+        slots = np.flatnonzero(alive)
+        columns = [getattr(self, '_' + name)[slots].tolist()
+                   for name in ('owner', 'source', 'next', 'target')]
+        for slot, key in zip(slots.tolist(), zip(*columns)):
+            self._groups.setdefault(key, []).append(slot)
+        counts = np.bincount(self._target[slots])
+        targets = np.flatnonzero(counts)
+        self._heading = dict(zip(targets.tolist(), counts[targets].tolist()))
+
+    def touched(self):
+        """
+        Returns the rows launched, freed, merged into, or moved onto a new
+        edge or a changed one since the last call.
+
+        Rows only moving along their edge are left out, as coast() can
+        follow them from their last state.
+        """
+        touched = self._touched
+        self._touched = set()
+        return sorted(touched)
+
+    def rows(self, slots):
+        """
+        Returns a dict of name -> NumPy array with the state of rows.
+        """
+        return dict([(name, getattr(self, '_' + name)[slots]) for name in STATE])
+
+    def update_rows(self, slots, state):
+        """
+        Overwrites rows with those of a rows() dict from another engine.
+
+        Views of rows freed or reused by another fleet arrive. Returns the
+        views of rows that became live or were reused, that is the fleets
+        launched since the last update.
+        """
+        for slot in slots:
+            while slot >= len(self._alive):
+                self._grow()
+            while slot >= self._size:
+                self._free.append(self._size)
+                self._size += 1
+        launched = []
+        for i, slot in enumerate(slots):
+            was_alive = bool(self._alive[slot])
+            old = (int(self._owner[slot]), int(self._target[slot]))
+            if was_alive:
+                self._leave_group(slot)
+                self._head_for(old[1], -1)
+            else:
+                self._free.remove(slot)
+            for name in STATE:
+                getattr(self, '_' + name)[slot] = state[name][i]
+            self._prev[slot] = self._current(slot)
+            fleet = self._fleets.get(slot)
+            reused = was_alive and old != (int(self._owner[slot]), int(self._target[slot]))
+            if fleet is not None and (reused or not self._alive[slot]):
+                del self._fleets[slot]
+                fleet._arrive()
+            elif fleet is not None:
+                fleet._units = int(self._units[slot])
+            if not self._alive[slot]:
+                self._jump[slot] = 1.0
+                self._free.append(slot)
+                continue
+            self._groups.setdefault(self._key(slot), []).append(slot)
+            self._head_for(int(self._target[slot]), 1)
+            if reused or not was_alive:
+                launched.append(self._view(slot))
+        heapify(self._free)
+        return launched
+
+    def coast(self, dt):
+        """
+        Moves every fleet dt seconds along its edge, stopping at its end,
+        for a copy of an engine stepped elsewhere.
+        """
+        size = self._size
+        dist = self._dist[:size]
+        dist += self._speed[:size] * dt
+        np.minimum(dist, self._jump[:size], dist)
+
+    def owners(self, slots):
+        """
+        Returns the owners of rows, as indices into settings.PLAYER.
+        """
+        return self._owner[slots]
+
+
+class Fleet(object):
+    """
+    View onto one row of a FleetEngine.
+
+    Owner, target and unit count are kept on the view as well, so they can
+    still be read once the fleet has arrived and its row was freed.
+
+    A fleet merged into another keeps the unit count it had, and follows
+    the position of the fleet it joined.
+    """
+    def __init__(self, engine, slot, units, player, target):
+        self._engine = engine
+        self._slot = slot
+        self._units = units
+        self._player = player
+        self._target = target
+        self._into = None
+        self._listeners = []
+        self._merge_listeners = []
+
+    def add_arrival_listener(self, callback):
+        self._listeners.append(callback)
+
+    def add_merge_listener(self, callback):
+        """
+        callback(fleet, into) is called when fleet joins the fleet into.
+        """
+        self._merge_listeners.append(callback)
+
+    def _arrive(self):
+        [callback(self) for callback in self._listeners]
+
+    def _merge(self, into):
+        self._into = into
+        [callback(self, into) for callback in self._merge_listeners]
+
+    def get_merged_into(self):
+        """
+        Returns the fleet this one joined, or None.
+        """
+        return self._into
+
+    def get_num_units(self):
+        return self._units
+
+    def get_target(self):
+        return self._target
+
+    def get_owner(self):
+        return self._player
+
+    def get_pos(self):
+        if self._into is not None:
+            return self._into.get_pos()
+        return self._engine.position(self._slot)
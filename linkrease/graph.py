@@ -0,0 +1,228 @@
+#This file is part of linkrease.
+
+#linkrease is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#linkrease is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+from bisect import bisect_left
+from itertools import izip
+
+import networkx as nx
+import numpy as np
+
+import settings
+
+NUMPY_TYPES = {
+    'b': np.int8,
+    'i': np.int32,
+    'd': np.float64,
+}
+
+
+def as_numpy(values):
+    """
+    Returns a NumPy array sharing memory with an array.array.
+    """
+    return np.frombuffer(values, dtype=NUMPY_TYPES[values.typecode])
+
+
+def _from_numpy(typecode, values):
+    """
+    Returns an array.array holding a copy of a NumPy array, made in one go.
+    """
+    result = array(typecode)
+    result.fromstring(np.ascontiguousarray(values, dtype=NUMPY_TYPES[typecode]).data)
+    return result
+
+
+#every array a CompactGraph is made of, with its typecode
+TYPECODES = {
+    'indptr': 'i',
+    'indices': 'i',
+    'edge_of': 'i',
+    'edge_u': 'i',
+    'edge_v': 'i',
+    'owner': 'b',
+    'garrison': 'i',
+    'factory': 'b',
+    'creased': 'b',
+    'highlight': 'b',
+    'weight': 'd',
+}
+ARRAYS = sorted(TYPECODES)
+
+
+class CompactGraph(object):
+    """
+    Undirected graph on nodes 0..n-1 kept in flat typed arrays.
+
+    Adjacency is stored CSR style: the neighbours of node n are
+    indices[indptr[n]:indptr[n + 1]] in ascending order, and edge_of gives
+    the edge id of each of those entries. Edge e joins edge_u[e] and
+    edge_v[e], with edge_u[e] < edge_v[e].
+
+    Node attributes: owner (index into settings.PLAYER), garrison, factory.
+    Edge attributes: creased, highlight, weight.
+
+    The arrays are array.array objects, so reading one entry is as cheap as
+    reading a list, and as_numpy() gives whole-array views for vectorised
+    work. They are never resized, so those views stay valid.
+    """
+    def __init__(self, positions, edges):
+        """
+        positions: sequence of (x, y), one per node
+        edges: sequence of (u, v) node pairs
+        """
+        size = len(positions)
+        self.positions = [(float(x), float(y)) for x, y in positions]
+
+        #one row per undirected edge, smallest node first
+        pairs = np.array([(u, v) for u, v in edges if u != v], dtype=np.int64).reshape(-1, 2)
+        pairs.sort(axis=1)
+        pairs = np.unique(pairs[:, 0] * size + pairs[:, 1])
+        edge_u, edge_v = pairs // size, pairs % size
+        count = len(pairs)
+        self.edge_u = _from_numpy('i', edge_u)
+        self.edge_v = _from_numpy('i', edge_v)
+
+        #both directions of every edge, ordered by node then neighbour
+        tails = np.concatenate((edge_u, edge_v))
+        heads = np.concatenate((edge_v, edge_u))
+        ids = np.concatenate((np.arange(count), np.arange(count)))
+        order = np.lexsort((heads, tails))
+        self.indices = _from_numpy('i', heads[order])
+        self.edge_of = _from_numpy('i', ids[order])
+        indptr = np.zeros(size + 1, dtype=np.int32)
+        np.cumsum(np.bincount(tails, minlength=size), out=indptr[1:])
+        self.indptr = _from_numpy('i', indptr)
+
+        self.owner = array('b', [0]) * size
+        self.garrison = array('i', [0]) * size
+        self.factory = array('b', [0]) * size
+        self.creased = array('b', [0]) * count
+        self.highlight = array('b', [0]) * count
+        self.weight = array('d', [0.0]) * count
+
+    def number_of_nodes(self):
+        return len(self.positions)
+
+    def number_of_edges(self):
+        return len(self.edge_u)
+
+    def edge_id(self, n1, n2):
+        """
+        Returns the id of the edge joining n1 and n2.
+
+        Raises KeyError if there is no such edge.
+        """
+        indices = self.indices
+        lo = self.indptr[n1]
+        hi = self.indptr[n1 + 1]
+        k = bisect_left(indices, n2, lo, hi)
+        if k == hi or indices[k] != n2:
+            raise KeyError((n1, n2))
+        return self.edge_of[k]
+
+    def neighbours(self, n):
+        """
+        Returns (node, edge id) pairs for every edge of n.
+        """
+        lo = self.indptr[n]
+        hi = self.indptr[n + 1]
+        return zip(self.indices[lo:hi], self.edge_of[lo:hi])
+
+    def edges_iter(self):
+        return izip(self.edge_u, self.edge_v)
+
+    def incident_edges(self, nodes):
+        """
+        Returns a sorted NumPy array of the ids of edges touching any node
+        in nodes.
+        """
+        nodes = np.asarray(nodes, dtype=np.int32)
+        indptr = as_numpy(self.indptr)
+        starts = indptr[nodes]
+        lengths = indptr[nodes + 1] - starts
+        #positions of every neighbour entry of every node, in one array
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        entries = offsets + np.arange(lengths.sum())
+        return np.unique(as_numpy(self.edge_of)[entries])
+
+    def arrays(self):
+        """
+        Returns a dict of name -> array.array for every name in ARRAYS.
+        """
+        return dict([(name, getattr(self, name)) for name in ARRAYS])
+
+    @classmethod
+    def from_arrays(cls, positions, arrays):
+        """
+        Builds a CompactGraph straight from the arrays of another, as given
+        by arrays(), without sorting or checking anything.
+
+        Each array is copied whole into an array.array, which routing reads
+        one item at a time far faster than a NumPy array.
+
+        positions: NumPy array of one (x, y) row per node
+        arrays: dict of name -> NumPy array, for every name in ARRAYS
+        """
+        graph = cls.__new__(cls)
+        graph.positions = map(tuple, np.asarray(positions, dtype=np.float64).tolist())
+        for name in ARRAYS:
+            setattr(graph, name, _from_numpy(TYPECODES[name], arrays[name]))
+        return graph
+
+    @classmethod
+    def from_networkx(cls, G):
+        """
+        Builds a CompactGraph from a networkx graph with a G.pos dict.
+
+        Nodes are renumbered 0..n-1 in sorted order. The owner, garrison,
+        factory, creased and highlight attributes are copied where set.
+        """
+        nodes = sorted(G.nodes())
+        index = dict([(n, i) for i, n in enumerate(nodes)])
+        graph = cls([G.pos[n] for n in nodes],
+                    [(index[u], index[v]) for u, v in G.edges_iter()])
+
+        for n, attr in G.nodes_iter(data=True):
+            i = index[n]
+            if 'owner' in attr:
+                graph.owner[i] = settings.PLAYER.index(attr['owner'])
+            graph.garrison[i] = attr.get('garrison', 0)
+            graph.factory[i] = bool(attr.get('factory', False))
+        for u, v, attr in G.edges_iter(data=True):
+            if u == v:
+                continue
+            e = graph.edge_id(index[u], index[v])
+            graph.creased[e] = bool(attr.get('creased', False))
+            graph.highlight[e] = bool(attr.get('highlight', False))
+            graph.weight[e] = attr.get('weight', 0.0)
+        return graph
+
+    def to_networkx(self):
+        """
+        Returns a networkx graph holding the same nodes, edges, attributes
+        and G.pos dict.
+        """
+        G = nx.Graph()
+        for n in xrange(self.number_of_nodes()):
+            G.add_node(n, owner=settings.PLAYER[self.owner[n]],
+                       garrison=self.garrison[n],
+                       factory=bool(self.factory[n]))
+        for e, (u, v) in enumerate(self.edges_iter()):
+            G.add_edge(u, v, creased=bool(self.creased[e]),
+                       highlight=bool(self.highlight[e]),
+                       weight=self.weight[e])
+        G.pos = dict(enumerate(self.positions))
+        return G
@@ -0,0 +1,97 @@
+#This file is part of linkrease.
+
+#linkrease is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#linkrease is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Runs the game model without a window, cocos or pyglet.
+
+usage: python headless.py [ticks] [nodes] [launches per tick]
+"""
+
+import random
+import time
+
+import levels
+import settings
+import simulation
+
+
+class HeadlessGame(object):
+    """
+    Drives a Map on a fixed timestep as fast as the CPU allows.
+    """
+    def __init__(self, map=None, step=settings.HEADLESS_STEP, seed=None):
+        self.map = map or levels.generate_random_level()
+        self.simulation = simulation.Simulation(self.map, 1.0 / step)
+        self.step = step
+        self.ticks = 0
+        self.random = random.Random(seed)
+
+    def launch(self, player, source, target):
+        """
+        Sends one unit from source to target on the next tick, as a mouse
+        drag would.
+        """
+        self.simulation.command('select_node', player, source)
+        self.simulation.command('target_node', player, target)
+        self.simulation.command('move_units_to_target', player)
+        self.simulation.command('select_node', player, None)
+
+    def launch_random(self, player):
+        """
+        Sends one unit from a random node of player to a random other node.
+        Does nothing if player owns no nodes.
+        """
+        owned = [n for n in self.map.nodes_iter() if self.map.get_owner(n) is player]
+        if not owned:
+            return
+        source = self.random.choice(owned)
+        target = self.random.randrange(self.map.number_of_nodes())
+        if target != source:
+            self.launch(player, source, target)
+
+    def tick(self):
+        """
+        Advances the game by one step and returns the fleets that arrived.
+        """
+        self.ticks += 1
+        return self.simulation.step()
+
+    def run(self, ticks, launches_per_tick=0):
+        """
+        Runs ticks steps, launching random fleets for every player first.
+        """
+        players = settings.PLAYER[1:]
+        for t in xrange(ticks):
+            for l in xrange(launches_per_tick):
+                self.launch_random(players[l % len(players)])
+            self.tick()
+
+
+def main(argv):
+    ticks = int(argv[1]) if len(argv) > 1 else 600
+    nodes = int(argv[2]) if len(argv) > 2 else 180
+    launches = int(argv[3]) if len(argv) > 3 else 1
+
+    game = HeadlessGame(levels.generate_random_level(nodes=nodes, seed=0), seed=0)
+    start = time.time()
+    game.run(ticks, launches)
+    elapsed = time.time() - start
+    print('%d ticks in %.3fs (%.1f ticks/s), %d fleets in flight' % (
+        ticks, elapsed, ticks / elapsed, len(game.map.fleets())))
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main(sys.argv))
@@ -13,17 +13,185 @@
 #You should have received a copy of the GNU General Public License
 #along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
 
+import ctypes
 from math import atan2, degrees
 
+import numpy as np
+import pyglet
+from pyglet import gl
+
 import cocos
 from cocos.sprite import Sprite
 from cocos.batch import BatchNode
 from cocos.actions import *
 
 import settings
+from assets import IMAGE_DATA
+from models import edge_key
 from multiplayer import neutral_player
 
 
+def upload(target, values):
+    """
+    Copies a NumPy array into a pyglet vertex attribute in one go.
+    """
+    values = np.ascontiguousarray(values)
+    ctypes.memmove(target, values.ctypes.data, values.nbytes)
+
+
+class LinkLines(cocos.cocosnode.CocosNode):
+    """
+    Draws every link of a map as GL lines from a single vertex list.
+
+    Link e of the map owns vertices 2e and 2e + 1, so recolouring a link
+    is a write to one slice of the colour buffer. The index buffer lists
+    only the links to draw, see show().
+    """
+    def __init__(self, map):
+        super(LinkLines, self).__init__()
+        self.map = map
+        self.width = settings.LINK_WIDTH
+
+        graph = map.get_graph()
+        xy = np.array(map.get_positions()).reshape(-1, 2) * (settings.LVL_W, settings.LVL_H)
+        ends = np.empty((graph.number_of_edges(), 2), dtype=np.int32)
+        ends[:, 0] = graph.edge_u
+        ends[:, 1] = graph.edge_v
+        vertices = xy[ends.ravel()].ravel()
+
+        count = len(vertices) // 2
+        self.shown = count // 2
+        self.vertex_list = pyglet.graphics.vertex_list_indexed(
+            count,
+            range(count),
+            ('v2f/static', vertices.tolist()),
+            ('c3B/dynamic', [0] * (count * 3)),
+        )
+
+    def show(self, edges):
+        """
+        Draws only the links whose ids are in the NumPy array edges.
+        """
+        self.shown = len(edges)
+        if not self.shown:
+            return
+        indices = np.empty((self.shown, 2), dtype=np.uint32)
+        indices[:, 0] = edges * 2
+        indices[:, 1] = edges * 2 + 1
+        self.vertex_list.resize(self.vertex_list.get_size(), indices.size)
+        upload(self.vertex_list.indices, indices)
+
+    def set_colour(self, n1, n2, colour):
+        i = self.map.get_graph().edge_id(n1, n2) * 6
+        self.vertex_list.colors[i:i + 6] = colour * 2
+
+    def draw(self):
+        if not self.shown:
+            return
+        gl.glPushMatrix()
+        self.transform()
+        gl.glLineWidth(self.width)
+        self.vertex_list.draw(gl.GL_LINES)
+        gl.glPopMatrix()
+
+
+class FleetQuads(cocos.cocosnode.CocosNode):
+    """
+    Draws every fleet as a textured quad from a single vertex list.
+
+    Positions of all fleets are computed in one array operation by the
+    map's FleetEngine and copied into the vertex buffer in one go.
+
+    Fleets outside rect (map space) are dropped before upload. With
+    aggregate set, fleets of one owner sharing a LOD_FLEET_CELL pixel cell
+    are drawn as a single marker at their mean position.
+    """
+    def __init__(self, map, image, colours):
+        """
+        colours: dict of player -> (r, g, b)
+        """
+        super(FleetQuads, self).__init__()
+        self.engine = map.get_fleet_engine()
+        self.texture = image.get_texture()
+        self.colours = np.array([colours[p] for p in settings.PLAYER], dtype=np.uint8)
+
+        #corners of a quad centred on a fleet, anticlockwise from bottom left
+        w = self.texture.width / 2.0
+        h = self.texture.height / 2.0
+        self.corners = np.array([(-w, -h), (w, -h), (w, h), (-w, h)], dtype=np.float32)
+
+        self.rect = None
+        self.aggregate = False
+        self.count = 0
+        self.vertex_list = pyglet.graphics.vertex_list(
+            4,
+            ('v2f/stream', [0.0] * 8),
+            ('c3B/stream', [0] * 12),
+            ('t3f/static', self.texture.tex_coords),
+        )
+
+    def update_quads(self):
+        slots, xy = self.engine.positions()
+        owners = self.engine.owners(slots)
+        if self.rect is not None:
+            x0, y0, x1, y1 = self.rect
+            inside = ((xy[:, 0] >= x0) & (xy[:, 0] <= x1) &
+                      (xy[:, 1] >= y0) & (xy[:, 1] <= y1))
+            xy = xy[inside]
+            owners = owners[inside]
+        centres = xy * (settings.LVL_W, settings.LVL_H)
+        if self.aggregate:
+            centres, owners = self.aggregated(centres, owners)
+
+        count = len(centres)
+        if count == 0:
+            self.count = 0
+            return
+
+        if count != self.count:
+            self.vertex_list.resize(4 * count)
+            tex_coords = np.array(self.texture.tex_coords, dtype=np.float32)
+            upload(self.vertex_list.tex_coords, np.tile(tex_coords, count))
+            self.count = count
+
+        vertices = centres.astype(np.float32)[:, None, :] + self.corners[None, :, :]
+        colours = np.repeat(self.colours[owners], 4, axis=0)
+        upload(self.vertex_list.vertices, vertices)
+        upload(self.vertex_list.colors, colours)
+
+    def aggregated(self, centres, owners):
+        """
+        Merges fleets of one owner in the same cell into one marker.
+        """
+        if not len(centres):
+            return centres, owners
+        cells = np.floor(centres / settings.LOD_FLEET_CELL).astype(np.int64)
+        cells -= cells.min(axis=0)
+        rows = cells[:, 1].max() + 1
+        players = len(settings.PLAYER)
+        keys = (cells[:, 0] * rows + cells[:, 1]) * players + owners
+        keys, groups = np.unique(keys, return_inverse=True)
+        sizes = np.bincount(groups).astype(np.float64)
+        merged = np.empty((len(keys), 2))
+        merged[:, 0] = np.bincount(groups, weights=centres[:, 0]) / sizes
+        merged[:, 1] = np.bincount(groups, weights=centres[:, 1]) / sizes
+        return merged, (keys % players).astype(np.int32)
+
+    def draw(self):
+        self.update_quads()
+        if not self.count:
+            return
+        gl.glPushMatrix()
+        self.transform()
+        gl.glEnable(gl.GL_BLEND)
+        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+        gl.glEnable(self.texture.target)
+        gl.glBindTexture(self.texture.target, self.texture.id)
+        self.vertex_list.draw(gl.GL_QUADS)
+        gl.glDisable(self.texture.target)
+        gl.glPopMatrix()
+
+
 class MapView(cocos.layer.scrolling.ScrollableLayer):
     def __init__(self, map):
         super(MapView, self).__init__()
@@ -32,33 +200,108 @@ class MapView(cocos.layer.scrolling.ScrollableLayer):
         self.px_height = settings.LVL_H
         self.map = map
         self.nodesprites = {}
-        self.linksprites = dict([(start, {end: None}) for start, end in self.map.edges_iter()])
+        self.linksprites = {}
         self.fleetsprites = {}
         self.colour_data = settings.COLOUR_DATA['game']
+        self.visible_nodes = set(self.map.nodes_iter())
+        self.low_detail = False
+        self.spinning = {}
+
+        #anything touching the view lies within one link of a visible node
+        positions = self.map.get_positions()
+        longest = max([0.0] + [abs(positions[n1][0] - positions[n2][0]) * settings.LVL_W +
+                               abs(positions[n1][1] - positions[n2][1]) * settings.LVL_H
+                               for n1, n2 in self.map.edges_iter()])
+        self.cull_margin = longest + settings.CULL_MARGIN
 
         self.init_node_sprites()
         self.init_link_sprites()
-        self.add(BatchNode(), z=3, name="units")
-
-        self.map.add_fleet_listener(self.on_fleet_launched)
+        if settings.FLEET_RENDERER == 'quads':
+            self.add(FleetQuads(map, IMAGE_DATA['unit'], self.colour_data['unit']),
+                     z=3, name="units")
+        else:
+            self.add(BatchNode(), z=3, name="units")
+            self.map.add_fleet_listener(self.on_fleet_launched)
+            #fleets already in flight, as in a game joined over the network
+            for fleet in self.map.fleets():
+                self.on_fleet_launched(fleet)
 
     def draw(self):
         for fleet, fleet_spr in self.fleetsprites.items():
             fleet_spr.position = self.pixel_from_map(*fleet.get_pos())
         super(MapView, self).draw()
 
-    def on_model_change(self):
-        if self.map.dirty_flag('nodes'):
-            self.update_node_sprites()
-        if self.map.dirty_flag('links'):
-            self.update_link_sprites()
-        if self.map.dirty_flag('units'):
-            self.update_unit_sprites()
+    def set_view(self, x, y, w, h, *args, **kwargs):
+        super(MapView, self).set_view(x, y, w, h, *args, **kwargs)
+        self.set_viewport(x, y, w, h, getattr(self.parent, 'scale', 1.0))
+
+    def set_viewport(self, x, y, w, h, scale):
+        """
+        Shows only nodes, links and fleets near the pixel rectangle
+        (x, y, w, h), and switches detail level according to scale.
+        """
+        pad = self.cull_margin
+        x0, y0 = self.map_from_pixel(x - pad, y - pad)
+        x1, y1 = self.map_from_pixel(x + w + pad, y + h + pad)
+        nodes = set(self.map.nodes_in_rect(x0, y0, x1, y1))
+
+        #only touch sprites that entered or left the view
+        for n in nodes ^ self.visible_nodes:
+            self.nodesprites[n].visible = n in nodes
+        edges = self.map.get_graph().incident_edges(list(nodes))
+        if settings.LINK_RENDERER == 'lines':
+            self.get('links').show(edges)
+        else:
+            old_edges = self.map.get_graph().incident_edges(list(self.visible_nodes))
+            self.show_link_sprites(np.setdiff1d(old_edges, edges), False)
+            self.show_link_sprites(np.setdiff1d(edges, old_edges), True)
+        self.visible_nodes = nodes
+
+        if settings.FLEET_RENDERER == 'quads':
+            self.get('units').rect = (x0, y0, x1, y1)
+        self.set_detail(scale < settings.LOD_SCALE and len(nodes) > settings.LOD_MIN_NODES)
+
+    def show_link_sprites(self, edges, visible):
+        graph = self.map.get_graph()
+        for e in edges:
+            self.linksprites[(graph.edge_u[e], graph.edge_v[e])].visible = visible
+
+    def set_detail(self, low):
+        """
+        Low detail stops the factories spinning, thins links and merges
+        fleet markers. Does nothing if the detail level is unchanged.
+        """
+        if low == self.low_detail:
+            return
+        self.low_detail = low
+
+        for n, spin in self.spinning.items():
+            if low:
+                self.nodesprites[n].remove_action(spin)
+                self.nodesprites[n].rotation = 0
+            else:
+                self.spinning[n] = self.nodesprites[n].do(Repeat(RotateBy(-360, 2)))
+        if settings.LINK_RENDERER == 'lines':
+            self.get('links').width = 1.0 if low else settings.LINK_WIDTH
+        if settings.FLEET_RENDERER == 'quads':
+            self.get('units').aggregate = low
+
+    def on_model_change(self, changes):
+        nodes = self.map.dirty('nodes')
+        if nodes:
+            self.update_node_sprites(nodes)
+        links = self.map.dirty('links')
+        if links:
+            self.update_link_sprites(links)
+        units = self.map.dirty('units')
+        if units:
+            self.update_unit_sprites(units)
 
     def on_fleet_launched(self, fleet):
         fleet.add_arrival_listener(self.on_fleet_arrived)
+        fleet.add_merge_listener(self.on_fleet_merged)
         fleet_sprite = Sprite(
-                image=settings.IMAGE_DATA['unit'],
+                image=IMAGE_DATA['unit'],
                 position=self.pixel_from_map(*fleet.get_pos()),
                 color=self.colour_data['unit'][fleet.get_owner()]
             )
@@ -70,6 +313,9 @@ class MapView(cocos.layer.scrolling.ScrollableLayer):
         self.get('units').remove(fleet_sprite)
         self.fleetsprites.pop(fleet)
 
+    def on_fleet_merged(self, fleet, into):
+        self.on_fleet_arrived(fleet)
+
     def map_from_pixel(self, x, y):
         """
         convert pixel coordinates into map space
@@ -94,9 +340,8 @@ class MapView(cocos.layer.scrolling.ScrollableLayer):
 
         raw_positions = self.map.get_positions()
         rotate_effect = Repeat(RotateBy(-360, 2))
-        for n in raw_positions:
+        for n, (x, y) in enumerate(raw_positions):
             #get node position
-            x, y = raw_positions[n]
             pos = (x * settings.LVL_W, y * settings.LVL_H)
 
             #get type of node
@@ -104,10 +349,11 @@ class MapView(cocos.layer.scrolling.ScrollableLayer):
 
             #make sprite
             node_spr = Sprite(
-                image=settings.IMAGE_DATA[type],
+                image=IMAGE_DATA[type],
                 position=pos,
             )
-            type != "factory" or node_spr.do(rotate_effect)
+            if type == "factory":
+                self.spinning[n] = node_spr.do(rotate_effect)
             self.nodesprites[n] = node_spr
             nodes.add(node_spr)
 
@@ -119,10 +365,14 @@ class MapView(cocos.layer.scrolling.ScrollableLayer):
     def init_link_sprites(self, wipe=False):
         if wipe:
             #wipe old sprites
-            for start, end in self.map.edges_iter():
-                self.linksprites[start][end] = None
+            self.linksprites = {}
             self.remove("links")
 
+        if settings.LINK_RENDERER == 'lines':
+            self.add(LinkLines(self.map), z=0, name="links")
+            self.update_link_sprites()
+            return
+
         #make links
         links = BatchNode()
         for start, end in self.map.edges_iter():
@@ -138,7 +388,7 @@ class MapView(cocos.layer.scrolling.ScrollableLayer):
             type = self.map.get_type(start, end)
 
             link_spr = Sprite(
-                image=settings.IMAGE_DATA[type],
+                image=IMAGE_DATA[type],
                 position=pos,
                 rotation=-degrees(atan2(
                     (end_node.y - start_node.y),
@@ -147,7 +397,7 @@ class MapView(cocos.layer.scrolling.ScrollableLayer):
             )
 
             #add link to lists
-            self.linksprites[start][end] = link_spr
+            self.linksprites[edge_key(start, end)] = link_spr
             links.add(link_spr)
 
         #add sprites to map_layer
@@ -155,16 +405,37 @@ class MapView(cocos.layer.scrolling.ScrollableLayer):
 
         self.update_link_sprites()
 
-    def update_link_sprites(self):
-        for n1, n2 in self.map.edges_iter():
+    def update_link_sprites(self, edges=None):
+        """
+        Recolours the sprites of edges, or of every edge if edges is None.
+        """
+        if edges is None:
+            self.map.dirty('links')
+            edges = self.map.edges_iter()
+        if settings.LINK_RENDERER == 'lines':
+            lines = self.get('links')
+            for n1, n2 in edges:
+                highlighted = self.map.get_highlight(n1, n2)
+                type = self.map.get_type(n1, n2)
+                lines.set_colour(n1, n2, self.colour_data[type][highlighted])
+            return
+
+        for n1, n2 in edges:
             highlighted = self.map.get_highlight(n1, n2)
             type = self.map.get_type(n1, n2)
 
-            self.linksprites[n1][n2].color = self.colour_data[type][highlighted]
-            self.linksprites[n1][n2].image = settings.IMAGE_DATA[type]
+            link_spr = self.linksprites[edge_key(n1, n2)]
+            link_spr.color = self.colour_data[type][highlighted]
+            link_spr.image = IMAGE_DATA[type]
 
-    def update_node_sprites(self):
-        for n in self.map.nodes_iter():
+    def update_node_sprites(self, nodes=None):
+        """
+        Recolours the sprites of nodes, or of every node if nodes is None.
+        """
+        if nodes is None:
+            self.map.dirty('nodes')
+            nodes = self.map.nodes_iter()
+        for n in nodes:
             owner = self.map.get_owner(n)
             type = self.map.get_type(n)
 
@@ -174,5 +445,5 @@ class MapView(cocos.layer.scrolling.ScrollableLayer):
             elif self.nodesprites[n].scale is 1.0:
                 self.nodesprites[n].do(ScaleTo(2.0, 0.5))
 
-    def update_unit_sprites(self):
+    def update_unit_sprites(self, nodes=None):
         pass
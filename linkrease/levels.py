@@ -13,13 +13,138 @@
 #You should have received a copy of the GNU General Public License
 #along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import os
+import random
+from math import sqrt
+from threading import Thread
+
 import networkx as nx
 
 import models
 import settings
+import snapshot
+import spatial
+
+#tries at placing a node before the repel distance is ignored for it
+PLACEMENT_ATTEMPTS = 1000
+
+#nodes random placement fits in the unit square, times repel squared,
+#with room to spare (it jams at about 0.7)
+PACKING = 0.5
+
+#change whenever the same arguments start giving a different level, so
+#levels cached before are no longer used
+GENERATOR_VERSION = 1
 
+#background thread generating the next random level, and its result
+_prefetch_thread = None
+_prefetched = []
 
-def generate_random_level(nodes=180, radius=0.1, repel=0.05, players=2):
+
+def random_positions(nodes, repel, rand):
+    """
+    Returns nodes random points in the unit square, kept at least repel
+    apart where possible.
+
+    repel is first lowered to what that many nodes can fit, see PACKING.
+    Candidates are only checked against points in neighbouring grid
+    buckets. A node that fails PLACEMENT_ATTEMPTS times is placed anyway,
+    and as the square is then full every node after it is placed at the
+    first try.
+    """
+    repel = min(repel, sqrt(PACKING / nodes))
+    cells = int(1.0 / repel) if repel > 0.0 else 1
+    cells = max(1, min(cells, int(sqrt(nodes)) + 1))
+    buckets = {}
+    positions = []
+    repel2 = repel * repel
+    attempts = PLACEMENT_ATTEMPTS
+    for n in xrange(nodes):
+        for attempt in xrange(attempts):
+            x, y = rand.random(), rand.random()
+            i, j = int(x * cells), int(y * cells)
+            clear = True
+            for bi in xrange(i - 1, i + 2):
+                for bj in xrange(j - 1, j + 2):
+                    for px, py in buckets.get((bi, bj), ()):
+                        if (x - px) ** 2 + (y - py) ** 2 < repel2:
+                            clear = False
+                            break
+                    if not clear:
+                        break
+                if not clear:
+                    break
+            if clear:
+                break
+        else:
+            attempts = 1
+        buckets.setdefault((i, j), []).append((x, y))
+        positions.append((x, y))
+    return positions
+
+
+def random_connected_geometric_graph(nodes, radius, repel, seed=None):
+    """
+    Returns a connected random geometric graph on the unit square.
+
+    Nodes closer than radius are linked, found through a grid of buckets
+    rather than by checking every pair. Any components left over are then
+    bridged to their nearest neighbouring component, so one pass always
+    gives a connected graph. The same seed gives the same graph.
+
+    The returned graph has a G.pos dict of node -> (x, y).
+
+    pre: nodes > 0
+    """
+    rand = random.Random(seed)
+    G = nx.Graph()
+    G.add_nodes_from(xrange(nodes))
+    positions = random_positions(nodes, repel, rand)
+    G.pos = dict(enumerate(positions))
+
+    #link nodes within radius
+    grid = spatial.SpatialGrid(positions, cells=max(1, int(1.0 / radius)))
+    radius2 = radius * radius
+    for u, (x, y) in G.pos.iteritems():
+        for v in grid.in_rect(x - radius, y - radius, x + radius, y + radius):
+            if u < v:
+                vx, vy = G.pos[v]
+                if (x - vx) ** 2 + (y - vy) ** 2 < radius2:
+                    G.add_edge(u, v)
+
+    #bridge components, smallest first, to the closest node outside them
+    components = nx.connected_components(G)
+    components.sort(key=len)
+    root = range(nodes)
+    for component in components:
+        for n in component:
+            root[n] = component[0]
+
+    def find(n):
+        while root[n] != n:
+            root[n] = root[root[n]]
+            n = root[n]
+        return n
+
+    for component in components[:-1]:
+        own = find(component[0])
+        inside = lambda n: find(n) == own
+        best = None
+        for u in component:
+            x, y = G.pos[u]
+            v = grid.nearest(x, y, exclude=inside)
+            vx, vy = G.pos[v]
+            dist = (x - vx) ** 2 + (y - vy) ** 2
+            if best is None or dist < best[0]:
+                best = (dist, u, v)
+        dist, u, v = best
+        G.add_edge(u, v)
+        root[own] = find(v)
+    return G
+
+
+def generate_random_level(nodes=180, radius=0.1, repel=0.05, players=2, seed=None):
     """
     Generates random graph.
     Occupies one planet per player.
@@ -29,20 +154,135 @@ def generate_random_level(nodes=180, radius=0.1, repel=0.05, players=2):
     pre: players > 0
     """
     #generate level
-    G = None
-    while G is None or not nx.is_connected(G):
-        G = nx.random_geometric_graph(
-            n=nodes,
-            radius=radius,
-            repel=repel,
-        )
+    G = random_connected_geometric_graph(nodes, radius, repel, seed)
 
     #setup map
     map = models.Map(G)
-    for n in xrange(nodes):
-        p = n + 1 if n < players else 0
-        map.set_owner(n, settings.PLAYER[p])
-        if p is not 0:
-            map.set_factory(n, True)
-            map.set_garrison(n, 10)
+    with map.batch():
+        for n in xrange(nodes):
+            p = n + 1 if n < players else 0
+            map.set_owner(n, settings.PLAYER[p])
+            if p is not 0:
+                map.set_factory(n, True)
+                map.set_garrison(n, 10)
+    return map
+
+
+def generator_key():
+    """
+    Returns a short hash of everything a generated level depends on besides
+    its arguments: the generator and snapshot versions and the settings
+    used for placement, creases, weights and routing landmarks.
+    """
+    key = (GENERATOR_VERSION, snapshot.VERSION, PLACEMENT_ATTEMPTS, PACKING,
+           settings.ADD_RANDOM_CREASES, settings.UNIT_SPEED['ratio'],
+           settings.LANDMARKS, settings.LANDMARK_MIN_NODES)
+    return hashlib.md5(repr(key)).hexdigest()[:8]
+
+
+def level_cache_path(nodes, radius, repel, players, seed, cache_dir=settings.LEVEL_CACHE_DIR):
+    """
+    Returns where the level for these arguments is cached. The name holds
+    generator_key(), so levels made by other code or settings are missed,
+    and a hash of the arguments, so any hashable seed can be used.
+    """
+    key = hashlib.md5(repr((nodes, radius, repel, players, seed))).hexdigest()
+    return os.path.join(cache_dir, 'level-%s-%s.lnkr' % (generator_key(), key[:16]))
+
+
+def evict_levels(cache_dir=settings.LEVEL_CACHE_DIR, max_bytes=settings.LEVEL_CACHE_BYTES):
+    """
+    Deletes the least recently used cached levels until the rest fit in
+    max_bytes.
+    """
+    files = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.lnkr'):
+            stat = os.stat(os.path.join(cache_dir, name))
+            files.append((stat.st_mtime, stat.st_size, name))
+    files.sort()
+    total = sum(size for mtime, size, name in files)
+    while files and total > max_bytes:
+        mtime, size, name = files.pop(0)
+        os.remove(os.path.join(cache_dir, name))
+        total -= size
+
+
+def cached_random_level(nodes=180, radius=0.1, repel=0.05, players=2, seed=None,
+                        cache_dir=settings.LEVEL_CACHE_DIR,
+                        max_bytes=settings.LEVEL_CACHE_BYTES):
+    """
+    Returns generate_random_level(nodes, radius, repel, players, seed),
+    loading it from cache_dir if it was made before.
+
+    New levels are saved there, with the routing landmarks they use, and
+    the least recently used are deleted once the cache passes max_bytes.
+    Levels without a seed are never the same twice, so are not cached.
+    """
+    if seed is None or cache_dir is None:
+        return generate_random_level(nodes, radius, repel, players, seed)
+    path = level_cache_path(nodes, radius, repel, players, seed, cache_dir)
+    try:
+        map = snapshot.read(path)[0]
+        os.utime(path, None)
+        return map
+    except (EnvironmentError, ValueError):
+        pass
+
+    map = generate_random_level(nodes, radius, repel, players, seed)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        #never leave a half written level under its real name
+        temp = '%s.%d.tmp' % (path, os.getpid())
+        snapshot.write(temp, map)
+        os.rename(temp, path)
+        evict_levels(cache_dir, max_bytes)
+    except EnvironmentError:
+        pass  # the game works without a cache
+    return map
+
+
+def _new_level():
+    return cached_random_level(seed=settings.LEVEL_SEED)
+
+
+def _generate_into(result):
+    result.append(_new_level())
+
+
+def prefetch_random_level():
+    """
+    Starts generating a random level in a background thread, so that
+    next_random_level() can return it without a wait.
+
+    Does nothing if a level is already being generated or waiting.
+    """
+    global _prefetch_thread
+    if _prefetch_thread is not None:
+        return
+    _prefetch_thread = Thread(target=_generate_into, args=(_prefetched,))
+    _prefetch_thread.daemon = True
+    _prefetch_thread.start()
+
+
+def next_random_level():
+    """
+    Returns a new random level, as cached_random_level() would with its
+    default arguments and settings.LEVEL_SEED.
+
+    The prefetched level is used if there is one, waiting for it to finish
+    if needed. The level after it is not started: call
+    prefetch_random_level() when generating it will not slow a game down.
+    """
+    global _prefetch_thread
+    if _prefetch_thread is None:
+        prefetch_random_level()
+    _prefetch_thread.join()
+    _prefetch_thread = None
+    if _prefetched:
+        map = _prefetched.pop()
+    else:
+        #the background thread failed, let any error show here
+        map = _new_level()
     return map
@@ -0,0 +1,282 @@
+#This file is part of linkrease.
+
+#linkrease is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#linkrease is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Lockstep network games, where peers only send each other commands.
+
+Every peer runs the same Simulation on the same level. A command given on
+tick t is applied on tick t + INPUT_DELAY by every peer, and each peer
+says when it has sent all its commands for a tick. Until then a peer runs
+ahead guessing the others gave none. When a command arrives for a tick
+already run, the state captured before that tick is restored and the
+ticks since are run again with it.
+
+A peer is the player it said it was in its HELLO; commands it sends are
+only ever applied for that player.
+"""
+
+import asyncore
+import socket
+import struct
+
+import network
+import settings
+import simulation
+import snapshot
+
+#message types
+HELLO = 1  # player index
+INPUT = 2  # tick, sequence, command index and node
+DONE = 3  # tick: every command of the peer for tick was sent
+
+HELLO_MESSAGE = struct.Struct('<BB')
+INPUT_MESSAGE = struct.Struct('<BIHBi')
+DONE_MESSAGE = struct.Struct('<BI')
+
+
+class PeerConnection(network.Connection):
+    """
+    Connection to one other peer of a LockstepGame.
+    """
+    def __init__(self, game, sock=None):
+        network.Connection.__init__(self, sock, game.sockets)
+        self.game = game
+        self.player = None
+
+    def on_message(self, data):
+        kind = ord(data[0])
+        if kind == HELLO:
+            self.game.on_hello(self, HELLO_MESSAGE.unpack(data)[1])
+        elif self.player is None:
+            return
+        elif kind == INPUT:
+            kind, tick, sequence, command, node = INPUT_MESSAGE.unpack(data)
+            self.game.on_input(tick, self.player, sequence, command, node)
+        elif kind == DONE:
+            kind, tick = DONE_MESSAGE.unpack(data)
+            self.game.on_done(tick, self.player)
+
+    def handle_close(self):
+        self.game.leave(self)
+        self.close()
+
+
+class LockstepGame(asyncore.dispatcher):
+    """
+    One peer of a lockstep game.
+
+    Has the command() and update() of a Simulation, so a game view can use
+    it in place of one.
+    """
+    def __init__(self, map, player, peers, host='localhost', port=0,
+                 rate=settings.TICK_RATE, delay=settings.INPUT_DELAY,
+                 rollback=settings.ROLLBACK_TICKS):
+        """
+        player: the player this peer gives commands for
+        peers: number of other peers, the game waits until all are connected
+        port: port to listen on for peers, 0 for any free port (see address)
+        """
+        self.sockets = {}
+        asyncore.dispatcher.__init__(self, map=self.sockets)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(5)
+        self.address = self.socket.getsockname()
+
+        self.map = map
+        self.player = player
+        self.simulation = simulation.Simulation(map, rate)
+        self.peers = []
+        self.expected_peers = peers
+        self.delay = delay
+        self.rollback = rollback
+        self.rollbacks = 0
+
+        self._index = settings.PLAYER.index(player)
+        #commands by tick, as (player index, sequence, command, node)
+        self._inputs = {}
+        #last tick each other player finished sending commands for
+        self._done = {}
+        #state at the start of each tick not yet confirmed
+        self._states = {}
+        #earliest tick run without a command that has since arrived
+        self._replay_from = None
+        self._sequence = 0
+        self._accumulator = 0.0
+
+        #no command can reach the first ticks
+        self._done[self._index] = delay
+
+    def connect_to(self, host, port):
+        """
+        Connects to another peer listening at host and port.
+        """
+        peer = PeerConnection(self)
+        peer.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.connect((host, port))
+        self._greet(peer)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self._greet(PeerConnection(self, pair[0]))
+
+    def _greet(self, peer):
+        self.peers.append(peer)
+        peer.send_message(HELLO_MESSAGE.pack(HELLO, self._index))
+
+    def on_hello(self, peer, player):
+        """
+        Takes player as who peer is, unless it is this peer's own player,
+        taken by another peer or not a player at all.
+        """
+        taken = [self._index] + [p.player for p in self.peers]
+        if peer.player is None and 0 < player < len(settings.PLAYER) and player not in taken:
+            peer.player = player
+
+    def leave(self, peer):
+        if peer in self.peers:
+            self.peers.remove(peer)
+
+    def ready(self):
+        """
+        True once every peer is connected and has said who it is.
+        """
+        return (len(self.peers) == self.expected_peers and
+                all(peer.player is not None for peer in self.peers))
+
+    def confirmed_tick(self):
+        """
+        Returns the last tick whose commands from every peer are known.
+        """
+        others = [self._done.get(peer.player, 0) for peer in self.peers
+                  if peer.player is not None]
+        return min(others + [self._done[self._index]]) if others else 0
+
+    def _broadcast(self, data):
+        for peer in self.peers:
+            peer.send_message(data)
+
+    def command(self, name, player, *args):
+        """
+        Gives a command for this peer's player, applied INPUT_DELAY ticks
+        from now. player is ignored.
+        """
+        command, node = simulation.encode_command(name, args)
+        tick = self.simulation.tick + 1 + self.delay
+        self._sequence += 1
+        self.on_input(tick, self._index, self._sequence, command, node)
+        self._broadcast(INPUT_MESSAGE.pack(INPUT, tick, self._sequence, command, node))
+
+    def on_input(self, tick, player, sequence, command, node):
+        """
+        Adds a command of player for tick.
+
+        Commands that could not be applied on every peer are dropped: ones
+        naming nodes not on the map, and ones for ticks already confirmed.
+        """
+        try:
+            simulation.decode_command(command, node, self.map.number_of_nodes())
+        except ValueError:
+            return
+        if tick <= self.simulation.tick and tick not in self._states:
+            return
+        self._inputs.setdefault(tick, []).append((player, sequence, command, node))
+        if tick <= self.simulation.tick:
+            self._replay_from = min(tick, self._replay_from or tick)
+
+    def on_done(self, tick, player):
+        self._done[player] = max(tick, self._done.get(player, 0))
+
+    def _step(self):
+        """
+        Captures the state, then runs the next tick with every command
+        known for it, in the same order on every peer.
+        """
+        sim = self.simulation
+        tick = sim.tick + 1
+        self._states[tick] = snapshot.capture(self.map)
+        for player, sequence, command, node in sorted(self._inputs.get(tick, ())):
+            name, args = simulation.decode_command(command, node)
+            sim.command(name, settings.PLAYER[player], *args)
+        sim.step()
+
+    def _replay(self):
+        """
+        Goes back to the earliest tick a late command was for and runs
+        every tick since again.
+        """
+        sim = self.simulation
+        now = sim.tick
+        tick = self._replay_from
+        self._replay_from = None
+        snapshot.restore(self.map, self._states[tick])
+        sim.tick = tick - 1
+        while sim.tick < now:
+            self._step()
+        self.rollbacks += 1
+
+    def _forget(self):
+        """
+        Drops states and commands of ticks that are run and confirmed, as
+        no late command can reach them any more.
+        """
+        last = min(self.confirmed_tick(), self.simulation.tick)
+        for tick in [t for t in self._states if t <= last]:
+            del self._states[tick]
+        for tick in [t for t in self._inputs if t <= last]:
+            del self._inputs[tick]
+
+    def advance(self):
+        """
+        Runs one tick if peers are not too far behind, and returns whether
+        it did.
+        """
+        sim = self.simulation
+        if not self.ready() or sim.tick + 1 > self.confirmed_tick() + self.rollback:
+            return False
+        if self._replay_from is not None:
+            self._replay()
+        self._step()
+        #no more commands can be given for the tick the delay now reaches
+        done = sim.tick + self.delay
+        self._done[self._index] = done
+        self._broadcast(DONE_MESSAGE.pack(DONE, done))
+        self._forget()
+        return True
+
+    def poll(self, timeout=0.0):
+        asyncore.loop(timeout, map=self.sockets, count=1)
+        if self._replay_from is not None:
+            self._replay()
+
+    def update(self, dt):
+        """
+        Handles messages from peers and runs the ticks dt seconds cover, as
+        Simulation.update() does.
+        """
+        self.poll()
+        self._accumulator += dt
+        ticks = 0
+        while self._accumulator >= self.simulation.dt and ticks < settings.MAX_TICKS_PER_UPDATE:
+            if not self.advance():
+                break
+            self._accumulator -= self.simulation.dt
+            ticks += 1
+        self._accumulator = min(self._accumulator, self.simulation.dt)
+        alpha = self._accumulator / self.simulation.dt
+        self.map.get_fleet_engine().alpha = alpha
+        return alpha
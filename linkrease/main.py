@@ -13,18 +13,69 @@
 #You should have received a copy of the GNU General Public License
 #along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
 
-from cocos.director import director
-
 import settings
-from scenes import IntroScene, MenuScene
 
 
-def main():
+def main(argv):
+    """
+    usage: python main.py [host:port]
+           python main.py lockstep player port seed [host:port]
+
+    With an address, joins the network game served there.
+
+    With lockstep, plays player (1 or 2) peer to peer on the level made
+    from seed, which every peer must give. Listens for the other peer on
+    port, or connects to it if its address is given.
+    """
+    if len(argv) > 1 and argv[1] == 'lockstep':
+        try:
+            player, port, seed = [int(arg) for arg in argv[2:5]]
+            peers = [(peer_host, int(peer_port)) for peer_host, peer_port in
+                     (address.rsplit(':', 1) for address in argv[5:])]
+        except ValueError:
+            return main.__doc__
+        if not 0 < player < len(settings.PLAYER):
+            return main.__doc__
+
+    #open the window before loading anything else
+    from cocos.director import director
     director.init(width=settings.SCR_W, height=settings.SCR_H, vsync=False)
     director.set_show_FPS(True)
+
+    if len(argv) > 1 and argv[1] == 'lockstep':
+        import levels
+        import lockstep
+        import multiplayer
+        from scenes import GameScene
+        player = settings.PLAYER[player]
+        #every other player is a peer
+        game = lockstep.LockstepGame(levels.cached_random_level(seed=seed), player,
+                                     len(settings.PLAYER) - 2, '', port)
+        for peer in peers:
+            game.connect_to(*peer)
+        multiplayer.set_current_player(player)
+        director.run(GameScene(game.map, simulation=game))
+        return
+
+    if len(argv) > 1:
+        import multiplayer
+        import network
+        from scenes import GameScene
+        host, port = argv[1].rsplit(':', 1)
+        client = network.GameClient(host, int(port))
+        if client.wait_for_map() is None:
+            return "could not join %s" % argv[1]
+        multiplayer.set_current_player(client.player)
+        director.run(GameScene(client.map, simulation=client))
+        return
+
+    #the model is loaded and the first level generated while the intro and
+    #menu are shown
+    from scenes import IntroScene, MenuScene, prefetch_level
+    prefetch_level()
     director.run(IntroScene() if not settings.SKIP_INTRO else MenuScene())
 
 
 if __name__ == "__main__":
     import sys
-    sys.exit(main())
+    sys.exit(main(sys.argv))
@@ -13,41 +13,97 @@
 #You should have received a copy of the GNU General Public License
 #along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
 
+from contextlib import contextmanager
 from math import sqrt
 
-import networkx as nx
+import numpy as np
 
 import settings
+import fleets
+import graph
 import levels
+import routing
+import spatial
 
-DIRTY_FLAG_KEYS = ['nodes', 'links', 'units', 'positions']
+DIRTY_KEYS = ['nodes', 'links', 'units']
+
+
+def edge_key(n1, n2):
+    """
+    Returns the same tuple for either direction of an edge.
+    """
+    return (n1, n2) if n1 <= n2 else (n2, n1)
+
+
+class ChangeSet(object):
+    """
+    What changed between two change events.
+
+    nodes: nodes whose owner, garrison or factory changed
+    edges: edge_key tuples whose crease or highlight changed
+    fleets: fleets that were launched or removed
+    """
+    def __init__(self):
+        self.nodes = set()
+        self.edges = set()
+        self.fleets = set()
+
+    def __nonzero__(self):
+        return bool(self.nodes or self.edges or self.fleets)
 
 
 class Map(object):
 
-    def __init__(self, base_graph):
-        self._G = base_graph or levels.generate_random_level()
+    def __init__(self, base_graph, fresh=True):
+        """
+        base_graph: a CompactGraph, or a networkx graph with a G.pos dict
+        fresh: add random creases, set every edge weight and pick routing
+            landmarks, as for a new level; False keeps the creases and
+            weights of base_graph and adds no landmarks
+        """
+        if base_graph is None:
+            base_graph = levels.generate_random_level().get_graph()
+        if not isinstance(base_graph, graph.CompactGraph):
+            base_graph = graph.CompactGraph.from_networkx(base_graph)
+        self._graph = base_graph
         self._selected_node = dict([(p, None) for p in settings.PLAYER])
         self._targeted_node = dict([(p, None) for p in settings.PLAYER])
-        self._fleet = []
+        self._route = dict([(p, set()) for p in settings.PLAYER])
         self._listeners = []
         self._fleet_listeners = []
-        self._dirty_flags = dict([(f, False) for f in DIRTY_FLAG_KEYS])
-
-        # set up nodes
-        for n in self._G.nodes_iter():
-            #sets 'garrison' property only if not already set
-            self.get_garrison(n)
-        # set up all edges
-        for n1, n2 in self._G.edges_iter():
-            #sets 'creased' property only if not already set
-            self.get_creased(n1, n2)
-            #removes highlights
-            self.set_highlight(n1, n2, False)
-
-            if settings.ADD_RANDOM_CREASES:
-                if (n1 % 3) == 0 and (n2 % 3) == 0:
-                    self.set_creased(n1, n2, True)
+        self._changes = ChangeSet()
+        self._batch_depth = 0
+        self._notify_pending = False
+        self._dirty = dict([(key, set()) for key in DIRTY_KEYS])
+        self._routing = routing.RoutingTable(self)
+        self._flow = routing.FlowFields(self)
+        self._astar = routing.AStar(self, min(1.0, settings.UNIT_SPEED['ratio']))
+        self._spatial = spatial.SpatialGrid(self.get_positions())
+        self._fleet = fleets.FleetEngine(self)
+        self._arrivals = []
+
+        if fresh:
+            self._set_up_edges()
+            if self.number_of_nodes() >= settings.LANDMARK_MIN_NODES:
+                self._astar.add_landmarks(settings.LANDMARKS)
+
+    def _set_up_edges(self):
+        """
+        Adds random creases, removes highlights and sets every edge weight.
+        """
+        n1 = graph.as_numpy(self._graph.edge_u)
+        n2 = graph.as_numpy(self._graph.edge_v)
+        creased = graph.as_numpy(self._graph.creased)
+        if settings.ADD_RANDOM_CREASES:
+            creased[((n1 % 3) == 0) & ((n2 % 3) == 0)] = True
+        #removes highlights
+        graph.as_numpy(self._graph.highlight)[:] = False
+        #same sum as set_creased, so both give identical weights
+        xy = np.array(self.get_positions()).reshape(-1, 2)
+        dx = xy[n1, 0] - xy[n2, 0]
+        dy = xy[n1, 1] - xy[n2, 1]
+        ratio = np.where(creased, settings.UNIT_SPEED['ratio'], 1.0)
+        graph.as_numpy(self._graph.weight)[:] = np.sqrt(dx * dx + dy * dy) * ratio
 
     def add_listener(self, callback):
         self._listeners.append(callback)
@@ -56,49 +112,98 @@ class Map(object):
         self._fleet_listeners.append(callback)
 
     def notify_listeners(self):
-        [callback() for callback in self._listeners]
+        """
+        Calls every listener with a ChangeSet of what changed since the
+        last call. Inside batch() the call is deferred until the batch ends.
+        """
+        if self._batch_depth:
+            self._notify_pending = True
+            return
+        self._notify_pending = False
+        changes = self._changes
+        self._changes = ChangeSet()
+        [callback(changes) for callback in self._listeners]
+
+    @contextmanager
+    def batch(self):
+        """
+        Defers change events until the outermost batch ends, then sends a
+        single ChangeSet covering every mutation made inside it.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+        if not self._batch_depth and self._notify_pending:
+            self.notify_listeners()
 
     def notify_fleet_listeners(self, fleet):
         [callback(fleet) for callback in self._fleet_listeners]
 
-    def dirty_flag(self, flag, clear_flag=True):
-        flag = self._dirty_flags[flag]
-        if clear_flag:
-            self._dirty_flags[flag] = False
-        return flag
+    def dirty(self, key, clear=True):
+        """
+        Returns what changed since the set for key was last cleared.
+
+        nodes: nodes whose owner, factory or garrison changed
+        links: edge_key tuples whose crease or highlight changed
+        units: nodes whose garrison changed
+        """
+        dirty = self._dirty[key]
+        if clear:
+            self._dirty[key] = set()
+        return dirty
 
     def set_owner(self, n, player, no_event=False):
-        self._G.node[n]['owner'] = player
+        self._graph.owner[n] = settings.PLAYER.index(player)
+        self._changes.nodes.add(n)
+        self._dirty['nodes'].add(n)
         no_event or self.notify_listeners()
 
     def get_owner(self, n):
-        return self._G.node[n]['owner']
+        return settings.PLAYER[self._graph.owner[n]]
 
     def get_weight(self, n1, n2):
-        return self._G.edge[n1][n2]['weight']
+        return self._graph.weight[self._graph.edge_id(n1, n2)]
 
     def set_weight(self, n1, n2, weight):
-        self._G.edge[n1][n2]['weight'] = weight
+        e = self._graph.edge_id(n1, n2)
+        old_weight = self._graph.weight[e]
+        self._graph.weight[e] = weight
+        self._routing.edge_changed(n1, n2, old_weight, weight)
+        self._flow.edge_changed(n1, n2, old_weight, weight)
+        self._astar.edge_changed(n1, n2, old_weight, weight)
+
+    def neighbours(self, n):
+        """
+        Returns (node, weight) pairs for every edge of n.
+        """
+        weight = self._graph.weight
+        return [(m, weight[e]) for m, e in self._graph.neighbours(n)]
+
+    def number_of_nodes(self):
+        return self._graph.number_of_nodes()
 
     def nodes_iter(self):
-        return self._G.nodes_iter()
+        return iter(xrange(self._graph.number_of_nodes()))
 
     def edges_iter(self):
-        return self._G.edges_iter()
+        return self._graph.edges_iter()
+
+    def get_graph(self):
+        return self._graph
+
+    def to_networkx(self):
+        return self._graph.to_networkx()
 
     def get_creased(self, n1, n2):
-        """
-        sets 'creased' property to False if not already set
-        """
-        try:
-            return self._G.edge[n1][n2]['creased']
-        except KeyError:
-            self.set_creased(n1, n2, False, no_event=True)
-        return False
+        return bool(self._graph.creased[self._graph.edge_id(n1, n2)])
 
     def set_creased(self, n1, n2, creased, no_event=False):
         #set flag
-        self._G.edge[n1][n2]['creased'] = creased
+        self._graph.creased[self._graph.edge_id(n1, n2)] = creased
+        self._changes.edges.add(edge_key(n1, n2))
+        self._dirty['links'].add(edge_key(n1, n2))
 
         #set weight
         positions = self.get_positions()
@@ -107,50 +212,35 @@ class Map(object):
         ratio = settings.UNIT_SPEED['ratio'] if creased else 1.0
         weight = sqrt(dx * dx + dy * dy) * ratio
         self.set_weight(n1, n2, weight)
+        self._fleet.edge_changed(n1, n2)
         no_event or self.notify_listeners()
 
     def get_highlight(self, n1, n2):
-        """
-        sets 'highlight' property to False if not already set
-        """
-        try:
-            return self._G.edge[n1][n2]['highlight']
-        except KeyError:
-            self.set_highlight(n1, n2, False, no_event=True)
-        return False
+        return bool(self._graph.highlight[self._graph.edge_id(n1, n2)])
 
     def set_highlight(self, n1, n2, highlight, no_event=False):
-        self._G.edge[n1][n2]['highlight'] = highlight
+        self._graph.highlight[self._graph.edge_id(n1, n2)] = highlight
+        self._changes.edges.add(edge_key(n1, n2))
+        self._dirty['links'].add(edge_key(n1, n2))
         no_event or self.notify_listeners()
 
     def get_factory(self, n):
-        """
-        sets 'factory' property to False if not already set
-        """
-        try:
-            return self._G.node[n]['factory']
-        except KeyError:
-            self.set_factory(n, False, no_event=True)
-        return False
+        return bool(self._graph.factory[n])
 
     def set_factory(self, n, factory, no_event=False):
-        self._G.node[n]['factory'] = factory
+        self._graph.factory[n] = factory
+        self._changes.nodes.add(n)
+        self._dirty['nodes'].add(n)
         no_event or self.notify_listeners()
 
     def get_garrison(self, n):
-        """
-        sets 'garrison' property to False if not already set
-        """
-        try:
-            return self._G.node[n]['garrison']
-        except KeyError:
-            self.set_garrison(n, 0, no_event=True)
-        return 0
+        return self._graph.garrison[n]
 
     def set_garrison(self, n, garrison, no_event=False):
-        self._G.node[n]['garrison'] = garrison
-        self._dirty_flags['units'] = True
-        self._dirty_flags['nodes'] = True
+        self._graph.garrison[n] = garrison
+        self._changes.nodes.add(n)
+        self._dirty['units'].add(n)
+        self._dirty['nodes'].add(n)
         no_event or self.notify_listeners()
 
     def deploy(self, n, units, player, no_event=False):
@@ -167,7 +257,7 @@ class Map(object):
         self.notify_listeners()
 
     def get_positions(self):
-        return self._G.pos
+        return self._graph.positions
 
     def get_type(self, n1, n2=None):
         if n2 is None:
@@ -176,22 +266,38 @@ class Map(object):
             return "crease" if self.get_creased(n1, n2) else "link"
 
     def shortest_path(self, source, target):
-        try:
-            # Get cache
-            cache = self._shortest_path
-        except AttributeError:
-            # Create cache
-            cache = self._shortest_path = {}
+        """
+        Returns the list of nodes on the shortest path from source to
+        target, or None if target is unreachable.
 
-        try:
-            # Get from cache
-            path = cache[(source, target)]
-        except KeyError:
-            # Add to cache
-            path = nx.shortest_path(self._G, source=source, target=target, weighted=True)
-            self._shortest_path[(source, target)] = path
+        Uses a precomputed routing row when there is one, else A*.
+        """
+        row = self._routing.cached(source)
+        if row is not None:
+            return row.path_to(target)
+        return self._astar.path(source, target)
 
-        return path
+    def next_hop(self, source, target):
+        """
+        Returns the node after source on the shortest path to target.
+
+        Returns None if source is target.
+
+        Uses the flow field of target, so every fleet heading there shares
+        one search.
+        """
+        return self._flow.next_hop(source, target)
+
+    def precompute_routes(self, sources=None, background=False):
+        """
+        Builds routing rows for sources, by default every node a player
+        owns, so that shortest_path() from them is a lookup.
+
+        background: build them in a daemon thread, which is returned
+        """
+        if sources is None:
+            sources = np.flatnonzero(graph.as_numpy(self._graph.owner)).tolist()
+        return self._routing.precompute(sources, background)
 
     def closest_node_to(self, x, y):
         """
@@ -201,22 +307,16 @@ class Map(object):
         pre: 0.0 <= y <= 1.0
         pre: self.number_of_nodes > 0
         """
-        #force to float
-        x *= 1.0
-        y *= 1.0
-
-        #init
-        dist = 2.0
-        node = None
-
-        for n, (nx, ny) in self.get_positions().items():
-            dx = x - nx
-            dy = y - ny
-            new_dist = dx * dx + dy * dy
-            if new_dist <= dist:
-                dist = new_dist
-                node = n
-        return node
+        return self._spatial.nearest(x * 1.0, y * 1.0)
+
+    def nodes_in_rect(self, x0, y0, x1, y1):
+        """
+        Returns the nodes inside a rectangle of map space.
+
+        pre: x0 <= x1
+        pre: y0 <= y1
+        """
+        return self._spatial.in_rect(x0, y0, x1, y1)
 
     def select_node(self, player, node, set_target=True):
         self._selected_node[player] = node
@@ -229,101 +329,124 @@ class Map(object):
     def target_node(self, player, node, force=False):
         if force or self._targeted_node[player] != node:
             self._targeted_node[player] = node
-            self._dirty_flags['links'] = True
-            self._dirty_flags['nodes'] = True
             self.highlight_route(player)
             self.notify_listeners()
 
     def targeted_node(self, player):
         return self._targeted_node[player]
 
-    def remove_fleet(self, fleet):
-        self._fleet.remove(fleet)
+    def fleets(self):
+        return self._fleet.fleets()
+
+    def get_fleet_engine(self):
+        return self._fleet
+
+    def get_route_finder(self):
+        return self._astar
+
+    def step_fleets(self, dt):
+        """
+        Moves every fleet forward by dt seconds.
+
+        Returns the fleets that reached their target this step. They are
+        queued until resolve_arrivals() is called.
+        """
+        arrived = self._fleet.step(dt)
+        for fleet in arrived:
+            self._changes.fleets.add(fleet)
+            fleet._arrive()
+        self._arrivals.extend(arrived)
+        return arrived
+
+    def resolve_arrivals(self):
+        """
+        Resolves combat at every node reached by queued fleets, all at once,
+        and sends a single change event.
+
+        At each node every player's arriving units are added up. The owner
+        fights with its garrison instead, as its own arrivals add nothing
+        (see deploy). The largest force takes the node and keeps the
+        difference to the second largest; the owner wins ties, and the
+        owner also keeps a node other players tie for, with no garrison.
+        One arriving fleet gives the same result as deploy.
+        """
+        arrived = self._arrivals
+        if not arrived:
+            return
+        self._arrivals = []
+        targets = np.array([fleet.get_target() for fleet in arrived], dtype=np.int32)
+        players = np.array([settings.PLAYER.index(fleet.get_owner()) for fleet in arrived],
+                           dtype=np.int32)
+        units = np.array([fleet.get_num_units() for fleet in arrived], dtype=np.int64)
+
+        #one row of forces per node, one column per player
+        nodes, rows = np.unique(targets, return_inverse=True)
+        owner = graph.as_numpy(self._graph.owner)[nodes].astype(np.int32)
+        garrison = graph.as_numpy(self._graph.garrison)
+        forces = np.zeros((len(nodes), len(settings.PLAYER)), dtype=np.int64)
+        np.add.at(forces, (rows, players), units)
+        index = np.arange(len(nodes))
+        forces[index, owner] = garrison[nodes]
+
+        ranked = np.sort(forces, axis=1)
+        strongest = ranked[:, -1]
+        margin = strongest - ranked[:, -2]
+        winner = np.where(forces[index, owner] == strongest, owner, forces.argmax(axis=1))
+        #a tie between attackers takes nothing
+        winner = np.where(margin == 0, owner, winner)
+
+        graph.as_numpy(self._graph.owner)[nodes] = winner
+        garrison[nodes] = margin
+        nodes = nodes.tolist()
+        self._changes.nodes.update(nodes)
+        self._dirty['nodes'].update(nodes)
+        self._dirty['units'].update(nodes)
+        self.notify_listeners()
+
+    def advance(self, dt):
+        """
+        Moves every fleet forward by dt seconds and resolves the arrivals,
+        sending a single change event for all of them.
+        """
+        arrived = self.step_fleets(dt)
+        self.resolve_arrivals()
+        return arrived
 
     def highlight_route(self, player):
         source = self._selected_node[player]
         target = self._targeted_node[player]
 
-        #wipe all other highlighting
-        for n1, n2 in self._G.edges_iter():
-            self.set_highlight(n1, n2, False, no_event=True)
-
-        #set highlight on new route
-        if source is not None and source is not target:
-            path = nx.shortest_path(self._G, source=source, target=target, weighted=True)
+        #find edges of new route
+        route = set()
+        if source is not None and source != target:
+            path = self.shortest_path(source, target)
             for n in xrange(len(path) - 1):
-                self.set_highlight(path[n], path[n + 1], True, no_event=True)
+                route.add(edge_key(path[n], path[n + 1]))
+        old_route = self._route[player]
+        self._route[player] = route
+
+        #only touch edges that left or joined the route
+        others = [r for p, r in self._route.items() if p is not player]
+        for n1, n2 in old_route - route:
+            if not any((n1, n2) in r for r in others):
+                self.set_highlight(n1, n2, False, no_event=True)
+        for n1, n2 in route - old_route:
+            self.set_highlight(n1, n2, True, no_event=True)
 
     def move_units_to_target(self, player, units=None):
+        """
+        Launches a fleet of player from its selected node to its targeted
+        node. Does nothing unless player owns the selected node.
+        """
         source = self._selected_node[player]
         target = self._targeted_node[player]
-        if source is not None and source is not target:
-            fleet = Fleet(1, player, self, source, target)
-            self._fleet.append(fleet)
-            self._dirty_flags['units'] = True
+        if source is not None and source != target and self.get_owner(source) is player:
+            fleet = self._fleet.launch(1, player, source, target)
+            if fleet.get_merged_into() is not None:
+                #no new fleet to show, only more units in an old one
+                self._changes.fleets.add(fleet.get_merged_into())
+                self.notify_listeners()
+                return
+            self._changes.fleets.add(fleet)
             self.notify_listeners()
             self.notify_fleet_listeners(fleet)
-
-
-class Fleet(object):
-    def __init__(self, units, player, map, source, target):
-        self._units = units
-        self._player = player
-        self._map = map
-        self._positions = self._map.get_positions()
-        self._source = source
-        self._target = target
-        self._next = self. _map.shortest_path(self._source, self._target)[1]
-        self._dist_from_prev = 0
-        self._jump_dist = self._map.get_weight(self._source, self._next)
-        self._listeners = []
-
-    def add_arrival_listener(self, callback):
-        self._listeners.append(callback)
-
-    def _arrive(self):
-        [callback(self) for callback in self._listeners]
-        self._map.remove_fleet(self)
-
-    def step_time(self, dt, *args, **kwargs):
-        while dt > 0.0:
-            link_type = self._map.get_type(self._source, self._next)
-            dist = settings.UNIT_SPEED[link_type] * dt
-            self._dist_from_prev += dist
-            if self._dist_from_prev - self._jump_dist >= 0.0:  # on next node
-                #move to next node
-                self._source = self._next
-                try:
-                    self._next = self._map.shortest_path(self._source, self._target)[1]
-                except IndexError:  # on last node, jump to bottom
-                    break
-                self._jump_dist = self._map.get_weight(self._source, self._next)
-
-                #reduce dt
-                dist -= (self._dist_from_prev - self._jump_dist)
-                dt -= dist * settings.UNIT_SPEED[link_type]
-                self._dist_from_prev = 0.0
-            else:
-                dt = 0
-        if self._source == self._next:  # on last node
-            self._arrive()
-
-    def get_num_units(self):
-        return self._units
-
-    def get_target(self):
-        return self._target
-
-    def get_owner(self):
-        return self._player
-
-    def get_pos(self):
-        ratio_complete = self._dist_from_prev / self._jump_dist
-        positions = self._positions
-        s = self._source
-        n = self._next
-
-        dx = positions[n][0] - positions[s][0]
-        dy = positions[n][1] - positions[s][1]
-        return ((dx * ratio_complete) + positions[s][0],
-                (dy * ratio_complete) + positions[s][1])
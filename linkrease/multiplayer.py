@@ -16,8 +16,19 @@
 import settings
 
 
+_current_player = settings.PLAYER[1]
+
+
 def current_player():
-    return settings.PLAYER[1]
+    """
+    Returns the player input on this machine is for.
+    """
+    return _current_player
+
+
+def set_current_player(player):
+    global _current_player
+    _current_player = player
 
 
 def neutral_player():
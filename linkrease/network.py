@@ -0,0 +1,381 @@
+#This file is part of linkrease.
+
+#linkrease is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#linkrease is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Networked games: an authoritative server and clients sending commands.
+
+The server owns the Map and runs the Simulation. A joining client gets a
+snapshot of the whole game once, then after each tick only what changed:
+nodes, creases and the fleet rows that did more than move along their
+edge. Clients move fleets along their edges themselves in between.
+
+What players select and target is never sent to other clients: each
+client highlights the route of its own player.
+
+Every message is a 4 byte length followed by a 1 byte type.
+
+usage: python network.py [port] [nodes] [seed]
+"""
+
+import asynchat
+import asyncore
+import socket
+import struct
+import time
+
+import numpy as np
+
+import fleets
+import graph
+import levels
+import settings
+import simulation
+import snapshot
+
+LENGTH = struct.Struct('<I')
+
+#message types
+WELCOME = 1  # server: player index, then a snapshot
+COMMAND = 2  # client: command index and node
+DELTA = 3  # server: tick and the changes it made
+
+WELCOME_HEADER = struct.Struct('<Bb')
+COMMAND_MESSAGE = struct.Struct('<BBi')
+DELTA_HEADER = struct.Struct('<BIIII')
+
+NODE_COLUMNS = (('owner', np.int8), ('garrison', np.int32), ('factory', np.int8))
+EDGE_COLUMNS = (('creased', np.int8),)
+
+
+def pack_delta(map, tick, nodes, edges, slots):
+    """
+    Returns a DELTA message with the state of nodes, edge ids and fleet
+    rows of map.
+    """
+    compact = map.get_graph()
+    nodes = np.array(sorted(nodes), dtype=np.int32)
+    edges = np.array(sorted(edges), dtype=np.int32)
+    slots = np.array(slots, dtype=np.int32)
+    parts = [DELTA_HEADER.pack(DELTA, tick, len(nodes), len(edges), len(slots)),
+             nodes.tostring()]
+    for name, dtype in NODE_COLUMNS:
+        parts.append(graph.as_numpy(getattr(compact, name))[nodes].astype(dtype).tostring())
+    parts.append(edges.tostring())
+    for name, dtype in EDGE_COLUMNS:
+        parts.append(graph.as_numpy(getattr(compact, name))[edges].astype(dtype).tostring())
+    parts.append(slots.tostring())
+    rows = map.get_fleet_engine().rows(slots)
+    parts.extend(rows[name].tostring() for name in fleets.STATE)
+    return ''.join(parts)
+
+
+def unpack_delta(data, engine):
+    """
+    Returns (tick, nodes, node columns, edges, edge columns, slots, rows)
+    from a DELTA message. engine gives the dtypes of fleet rows.
+    """
+    kind, tick, node_count, edge_count, slot_count = DELTA_HEADER.unpack_from(data, 0)
+    offset = [DELTA_HEADER.size]
+
+    def take(dtype, count):
+        values = np.frombuffer(data, dtype=dtype, count=count, offset=offset[0])
+        offset[0] += values.nbytes
+        return values
+    nodes = take(np.int32, node_count)
+    node_columns = dict([(name, take(dtype, node_count)) for name, dtype in NODE_COLUMNS])
+    edges = take(np.int32, edge_count)
+    edge_columns = dict([(name, take(dtype, edge_count)) for name, dtype in EDGE_COLUMNS])
+    slots = take(np.int32, slot_count)
+    rows = dict([(name, take(getattr(engine, '_' + name).dtype, slot_count))
+                 for name in fleets.STATE])
+    return tick, nodes, node_columns, edges, edge_columns, slots, rows
+
+
+class Connection(asynchat.async_chat):
+    """
+    Socket sending and receiving length prefixed messages.
+    """
+    def __init__(self, sock=None, sockets=None):
+        asynchat.async_chat.__init__(self, sock, sockets)
+        self._incoming = []
+        self._length = None
+        self.set_terminator(LENGTH.size)
+
+    def collect_incoming_data(self, data):
+        self._incoming.append(data)
+
+    def found_terminator(self):
+        data = ''.join(self._incoming)
+        self._incoming = []
+        if self._length is None:
+            self._length = LENGTH.unpack(data)[0]
+            self.set_terminator(self._length)
+        else:
+            self._length = None
+            self.set_terminator(LENGTH.size)
+            self.on_message(data)
+
+    def send_message(self, data):
+        self.push(LENGTH.pack(len(data)) + data)
+
+    def on_message(self, data):
+        pass
+
+
+class ServerConnection(Connection):
+    """
+    The server's end of a connection to one client.
+    """
+    def __init__(self, server, sock):
+        Connection.__init__(self, sock, server.sockets)
+        self.server = server
+        self.player = None
+
+    def on_message(self, data):
+        if ord(data[0]) == COMMAND:
+            kind, command, node = COMMAND_MESSAGE.unpack(data)
+            self.server.on_command(self, command, node)
+
+    def handle_close(self):
+        self.server.leave(self)
+        self.close()
+
+
+class GameServer(asyncore.dispatcher):
+    """
+    Runs the authoritative game and keeps every client up to date.
+
+    Clients are given the players after settings.PLAYER[0] in the order
+    they join; any more only watch.
+    """
+    def __init__(self, map, host='localhost', port=0, rate=settings.TICK_RATE):
+        """
+        port: port to listen on, 0 for any free port (see address)
+        """
+        self.sockets = {}
+        asyncore.dispatcher.__init__(self, map=self.sockets)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(5)
+        self.address = self.socket.getsockname()
+
+        self.map = map
+        self.simulation = simulation.Simulation(map, rate)
+        self.clients = []
+        self._nodes = set()
+        self._edges = set()
+        #EDGE_COLUMNS as last sent
+        self._sent = self._copy_edge_columns()
+        map.add_listener(self.on_model_change)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.join(ServerConnection(self, pair[0]))
+
+    def join(self, client):
+        taken = [c.player for c in self.clients]
+        free = [p for p in settings.PLAYER[1:] if p not in taken]
+        client.player = free[0] if free else None
+        self.clients.append(client)
+        index = settings.PLAYER.index(client.player) if client.player else -1
+        client.send_message(WELCOME_HEADER.pack(WELCOME, index) +
+                            snapshot.dumps(self.map, self.simulation.tick,
+                                           1.0 / self.simulation.dt, selections=False))
+
+    def leave(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+
+    def on_command(self, client, command, node):
+        """
+        Queues a command from client for its player. Commands from watchers
+        and ones naming nodes not on the map are dropped.
+        """
+        if client.player is None:
+            return
+        try:
+            name, args = simulation.decode_command(command, node, self.map.number_of_nodes())
+        except ValueError:
+            return
+        self.simulation.command(name, client.player, *args)
+
+    def on_model_change(self, changes):
+        self._nodes.update(changes.nodes)
+        self._edges.update(changes.edges)
+
+    def _copy_edge_columns(self):
+        compact = self.map.get_graph()
+        return [np.array(graph.as_numpy(getattr(compact, name))) for name, dtype in EDGE_COLUMNS]
+
+    def step(self):
+        """
+        Runs one tick and sends what it changed to every client.
+
+        Of the edges change events named, only those whose EDGE_COLUMNS
+        differ from what was last sent go out. Events also name edges whose
+        highlight changed, and sending those would give away other players'
+        routes.
+        """
+        self.simulation.step()
+        compact = self.map.get_graph()
+        edge_id = compact.edge_id
+        edges = np.array(sorted(edge_id(n1, n2) for n1, n2 in self._edges), dtype=np.int32)
+        changed = np.zeros(len(edges), dtype=np.bool_)
+        for (name, dtype), sent in zip(EDGE_COLUMNS, self._sent):
+            values = graph.as_numpy(getattr(compact, name))[edges]
+            changed |= values != sent[edges]
+            sent[edges] = values
+        edges = edges[changed]
+        slots = self.map.get_fleet_engine().touched()
+        if self._nodes or len(edges) or slots:
+            message = pack_delta(self.map, self.simulation.tick, self._nodes, edges, slots)
+            for client in self.clients:
+                client.send_message(message)
+        self._nodes = set()
+        self._edges = set()
+
+    def poll(self, timeout=0.0):
+        asyncore.loop(timeout, map=self.sockets, count=1)
+
+    def run(self, ticks=None):
+        """
+        Runs ticks ticks in real time, or until interrupted.
+        """
+        next_tick = time.time()
+        end = None if ticks is None else self.simulation.tick + ticks
+        while end is None or self.simulation.tick < end:
+            self.poll(max(0.0, next_tick - time.time()))
+            if time.time() >= next_tick:
+                self.step()
+                next_tick += self.simulation.dt
+
+
+class ClientConnection(Connection):
+    """
+    A client's connection to the server.
+    """
+    def __init__(self, client, host, port):
+        Connection.__init__(self, sockets=client.sockets)
+        self.client = client
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((host, port))
+
+    def on_message(self, data):
+        kind = ord(data[0])
+        if kind == WELCOME:
+            self.client.on_welcome(data)
+        elif kind == DELTA:
+            self.client.on_delta(data)
+
+    def handle_close(self):
+        self.client.connected = False
+        self.close()
+
+
+class GameClient(object):
+    """
+    Copy of a game run by a GameServer, to show and send commands to.
+
+    Has the command() and update() of a Simulation, so a game view can use
+    either.
+    """
+    def __init__(self, host='localhost', port=settings.NETWORK_PORT):
+        self.sockets = {}
+        self.map = None
+        self.player = None
+        self.tick = 0
+        self.connected = True
+        self._connection = ClientConnection(self, host, port)
+
+    def on_welcome(self, data):
+        kind, index = WELCOME_HEADER.unpack_from(data, 0)
+        self.player = settings.PLAYER[index] if index >= 0 else None
+        self.map, self.tick, rate, commands = snapshot.loads(data[WELCOME_HEADER.size:])
+
+    def on_delta(self, data):
+        map = self.map
+        engine = map.get_fleet_engine()
+        tick, nodes, node_columns, edges, edge_columns, slots, rows = unpack_delta(data, engine)
+        compact = map.get_graph()
+        with map.batch():
+            for i, n in enumerate(nodes.tolist()):
+                map.set_owner(n, settings.PLAYER[node_columns['owner'][i]], no_event=True)
+                map.set_garrison(n, int(node_columns['garrison'][i]), no_event=True)
+                map.set_factory(n, bool(node_columns['factory'][i]), no_event=True)
+            for i, e in enumerate(edges.tolist()):
+                n1, n2 = compact.edge_u[e], compact.edge_v[e]
+                creased = bool(edge_columns['creased'][i])
+                if creased != map.get_creased(n1, n2):
+                    map.set_creased(n1, n2, creased, no_event=True)
+            launched = engine.update_rows(slots.tolist(), rows)
+            map.notify_listeners()
+        for fleet in launched:
+            map.notify_fleet_listeners(fleet)
+        self.tick = tick
+
+    def poll(self, timeout=0.0):
+        asyncore.loop(timeout, map=self.sockets, count=1)
+
+    def wait_for_map(self, timeout=10.0):
+        """
+        Waits for the server's snapshot and returns the map, or None.
+        """
+        end = time.time() + timeout
+        while self.map is None and self.connected and time.time() < end:
+            self.poll(0.05)
+        return self.map
+
+    def command(self, name, player, *args):
+        """
+        Sends a command to the server. The server decides which player it
+        is for, so player is ignored.
+
+        Selecting and targeting also happen on the local map straight away,
+        to highlight the route without waiting for the server.
+        """
+        command, node = simulation.encode_command(name, args)
+        if name != 'move_units_to_target' and self.map is not None and self.player is not None:
+            getattr(self.map, name)(self.player, *args)
+        self._connection.send_message(COMMAND_MESSAGE.pack(COMMAND, command, node))
+
+    def update(self, dt):
+        """
+        Handles messages from the server and moves fleets along their
+        edges. Returns 1.0, as there is nothing to interpolate.
+        """
+        self.poll()
+        if self.map is not None:
+            self.map.get_fleet_engine().coast(dt)
+        return 1.0
+
+    def close(self):
+        self._connection.close()
+
+
+def main(argv):
+    port = int(argv[1]) if len(argv) > 1 else settings.NETWORK_PORT
+    nodes = int(argv[2]) if len(argv) > 2 else 180
+    seed = int(argv[3]) if len(argv) > 3 else None
+
+    server = GameServer(levels.cached_random_level(nodes=nodes, seed=seed), '', port)
+    print('serving on port %d' % server.address[1])
+    server.run()
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main(sys.argv))
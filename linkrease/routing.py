@@ -0,0 +1,464 @@
+#This file is part of linkrease.
+
+#linkrease is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#linkrease is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+from collections import OrderedDict
+from heapq import heappush, heappop
+from math import hypot
+from threading import Lock, Thread
+
+INFINITY = float('inf')
+NO_NODE = -1
+
+#nodes held by flow fields no fleet is heading for before the least
+#recently used of them is dropped, so bigger maps keep fewer idle fields
+FLOW_FIELD_NODES = 2000000
+
+#nodes held by all routing table rows together before the least recently
+#used row is dropped
+ROUTING_ROW_NODES = 2000000
+
+
+class ShortestPathTree(object):
+    """
+    Shortest path tree grown from a single root node.
+
+    Nodes are expected to be labelled 0..size-1, as produced by levels.
+
+    dist[n]: length of the shortest path from root to n
+    parent[n]: node before n on that path (the next hop from n to root)
+    first[n]: node after root on that path (the next hop from root to n)
+    """
+    def __init__(self, root, size):
+        self.root = root
+        self.dist = array('d', [INFINITY]) * size
+        self.parent = array('i', [NO_NODE]) * size
+        self.first = array('i', [NO_NODE]) * size
+
+    def grow(self, neighbours):
+        """
+        Runs Dijkstra from root.
+
+        neighbours(n) returns (node, weight) pairs for every edge of n.
+        """
+        self.dist[self.root] = 0.0
+        self._settle([(0.0, self.root)], neighbours)
+        return self
+
+    def _settle(self, heap, neighbours):
+        """
+        Runs Dijkstra on from the (dist, node) entries in heap, whose dist,
+        parent and first must already be set.
+        """
+        root = self.root
+        dist = self.dist
+        parent = self.parent
+        first = self.first
+
+        while heap:
+            d, n = heappop(heap)
+            if d > dist[n]:  # stale heap entry
+                continue
+            hop = first[n]
+            for m, weight in neighbours(n):
+                new_dist = d + weight
+                if new_dist < dist[m]:
+                    dist[m] = new_dist
+                    parent[m] = n
+                    first[m] = m if n == root else hop
+                    heappush(heap, (new_dist, m))
+
+    def repair(self, n1, n2, old_weight, new_weight, neighbours):
+        """
+        Updates the tree after the weight of edge n1-n2 changed, in the
+        manner of Ramalingam and Reps: only nodes whose shortest path
+        changes are touched.
+
+        neighbours(n) must already give the new weight.
+        """
+        if new_weight < old_weight:
+            self._shorten(n1, n2, new_weight, neighbours)
+        elif new_weight > old_weight:
+            if self.parent[n2] == n1:
+                self._lengthen(n2, neighbours)
+            elif self.parent[n1] == n2:
+                self._lengthen(n1, neighbours)
+        return self
+
+    def _shorten(self, n1, n2, weight, neighbours):
+        dist = self.dist
+        if dist[n1] + weight < dist[n2]:
+            u, v = n1, n2
+        elif dist[n2] + weight < dist[n1]:
+            u, v = n2, n1
+        else:
+            return
+        #v now goes through u, and so may anything beyond v
+        dist[v] = dist[u] + weight
+        self.parent[v] = u
+        self.first[v] = v if u == self.root else self.first[u]
+        self._settle([(dist[v], v)], neighbours)
+
+    def _lengthen(self, top, neighbours):
+        dist = self.dist
+        parent = self.parent
+        first = self.first
+
+        #only paths through top, the lower end of the edge, can change
+        subtree = []
+        stack = [top]
+        while stack:
+            n = stack.pop()
+            subtree.append(n)
+            stack.extend(m for m, weight in neighbours(n) if parent[m] == n)
+        for n in subtree:
+            dist[n] = INFINITY
+            parent[n] = NO_NODE
+            first[n] = NO_NODE
+
+        #enter the subtree again from its best neighbour outside it
+        heap = []
+        for n in subtree:
+            for m, weight in neighbours(n):
+                new_dist = dist[m] + weight
+                if new_dist < dist[n]:
+                    dist[n] = new_dist
+                    parent[n] = m
+                    first[n] = n if m == self.root else first[m]
+            if dist[n] < INFINITY:
+                heappush(heap, (dist[n], n))
+        self._settle(heap, neighbours)
+
+    def path_to(self, target):
+        """
+        Returns the list of nodes from root to target, or None if unreachable.
+        """
+        if self.dist[target] == INFINITY:
+            return None
+        parent = self.parent
+        path = [target]
+        while target != self.root:
+            target = parent[target]
+            path.append(target)
+        path.reverse()
+        return path
+
+    def affected_by(self, n1, n2, old_weight, new_weight):
+        """
+        True if changing the weight of edge n1-n2 could alter this tree.
+        """
+        if new_weight > old_weight:
+            #only paths through the edge get longer
+            return self.parent[n2] == n1 or self.parent[n1] == n2
+        #a shorter edge matters only if it improves a path
+        dist = self.dist
+        return (dist[n1] + new_weight < dist[n2] or
+                dist[n2] + new_weight < dist[n1])
+
+
+class RoutingTable(object):
+    """
+    Next-hop table holding one shortest path tree per source node.
+
+    Rows are built lazily on first use, or ahead of time with precompute().
+    When an edge weight changes the rows it affects are repaired in place.
+    At most capacity rows are kept, dropping the least recently used.
+    """
+    def __init__(self, map, capacity=None):
+        """
+        capacity: rows kept, defaults to ROUTING_ROW_NODES worth of nodes
+        """
+        if capacity is None:
+            capacity = max(1, ROUTING_ROW_NODES // max(1, map.number_of_nodes()))
+        self._map = map
+        self._capacity = capacity
+        self._rows = OrderedDict()
+        self._version = 0
+        self._lock = Lock()
+
+    def _build(self, source):
+        size = self._map.number_of_nodes()
+        return ShortestPathTree(source, size).grow(self._map.neighbours)
+
+    def row(self, source):
+        tree = self.cached(source)
+        if tree is not None:
+            return tree
+        with self._lock:
+            version = self._version
+        tree = self._build(source)
+        with self._lock:
+            if version == self._version:
+                self._rows[source] = tree
+                if len(self._rows) > self._capacity:
+                    self._rows.popitem(last=False)
+        return tree
+
+    def cached(self, source):
+        """
+        Returns the row of source if it is already built, else None.
+        """
+        with self._lock:
+            tree = self._rows.pop(source, None)
+            if tree is not None:
+                #most recently used last
+                self._rows[source] = tree
+        return tree
+
+    def next_hop(self, source, target):
+        """
+        Returns the node after source on the way to target.
+
+        Returns None when source is target or target is unreachable.
+        """
+        hop = self.row(source).first[target]
+        return None if hop == NO_NODE else hop
+
+    def path(self, source, target):
+        return self.row(source).path_to(target)
+
+    def precompute(self, sources=None, background=False):
+        """
+        Builds rows for sources (default: every node).
+
+        With background=True the rows are built in a daemon thread and the
+        thread is returned. Rows invalidated while being built are discarded.
+        """
+        if sources is None:
+            sources = range(self._map.number_of_nodes())
+        if not background:
+            for source in sources:
+                if self.cached(source) is None:
+                    self.row(source)
+            return None
+        thread = Thread(target=self.precompute, args=(sources,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def edge_changed(self, n1, n2, old_weight, new_weight):
+        """
+        Repairs every row the new weight of edge n1-n2 makes stale.
+
+        Rows still being built by precompute() are discarded.
+        """
+        if old_weight == new_weight:
+            return
+        neighbours = self._map.neighbours
+        with self._lock:
+            self._version += 1
+            for tree in self._rows.values():
+                if tree.affected_by(n1, n2, old_weight, new_weight):
+                    tree.repair(n1, n2, old_weight, new_weight, neighbours)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._rows.clear()
+
+
+class FlowFields(object):
+    """
+    Next-hop table holding one shortest path tree per target node.
+
+    Links are undirected, so in a tree grown from the target the parent of
+    every node is its next hop towards that target. All fleets heading for
+    one target share a single tree, whichever nodes they left from.
+
+    Trees of targets fleets are in flight to are always kept, as fleets
+    need them at every node they reach. At most capacity others are kept,
+    dropping the least recently used.
+    """
+    def __init__(self, map, capacity=None):
+        """
+        capacity: idle trees kept, defaults to FLOW_FIELD_NODES worth of
+            nodes
+        """
+        if capacity is None:
+            capacity = max(1, FLOW_FIELD_NODES // max(1, map.number_of_nodes()))
+        self._map = map
+        self._capacity = capacity
+        self._fields = OrderedDict()
+
+    def field(self, target):
+        fields = self._fields
+        try:
+            tree = fields.pop(target)
+        except KeyError:
+            size = self._map.number_of_nodes()
+            tree = ShortestPathTree(target, size).grow(self._map.neighbours)
+            self._evict()
+        #most recently used last
+        fields[target] = tree
+        return tree
+
+    def _evict(self):
+        """
+        Drops the least recently used trees no fleet is heading for, until
+        there is room for one more.
+        """
+        in_flight = self._map.get_fleet_engine().in_flight
+        idle = [target for target in self._fields if not in_flight(target)]
+        for target in idle[:max(0, len(idle) - self._capacity + 1)]:
+            del self._fields[target]
+
+    def next_hop(self, node, target):
+        """
+        Returns the node after node on the way to target.
+
+        Returns None when node is target or target is unreachable.
+        """
+        hop = self.field(target).parent[node]
+        return None if hop == NO_NODE else hop
+
+    def edge_changed(self, n1, n2, old_weight, new_weight):
+        """
+        Repairs every field the new weight of edge n1-n2 makes stale.
+        """
+        if old_weight == new_weight:
+            return
+        neighbours = self._map.neighbours
+        for tree in self._fields.values():
+            if tree.affected_by(n1, n2, old_weight, new_weight):
+                tree.repair(n1, n2, old_weight, new_weight, neighbours)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def clear(self):
+        self._fields.clear()
+
+
+class AStar(object):
+    """
+    Point to point shortest paths, searched goal first with A*.
+
+    The heuristic is the straight line distance to the target times scale,
+    where scale is the smallest weight per unit of length of any link. With
+    landmarks added (ALT), the triangle inequality on distances to each
+    landmark gives a further lower bound, and the largest bound is used.
+    Both are consistent, so every node is settled at most once.
+    """
+    def __init__(self, map, scale=1.0):
+        """
+        scale: lower bound on edge weight divided by edge length
+        """
+        self._map = map
+        self._scale = scale
+        self._landmarks = []
+
+    def add_landmarks(self, count):
+        """
+        Grows shortest path trees from count more landmarks, each picked as
+        the node furthest from the landmarks already chosen.
+        """
+        size = self._map.number_of_nodes()
+        if not size:
+            return
+        closest = [INFINITY] * size
+        for tree in self._landmarks:
+            closest = map(min, closest, tree.dist)
+        for l in xrange(count):
+            if self._landmarks:
+                reachable = [(d, n) for n, d in enumerate(closest) if d < INFINITY]
+                root = max(reachable)[1] if reachable else 0
+            else:
+                root = 0
+            tree = ShortestPathTree(root, size).grow(self._map.neighbours)
+            self._landmarks.append(tree)
+            closest = map(min, closest, tree.dist)
+
+    def landmarks(self):
+        return [tree.root for tree in self._landmarks]
+
+    def state(self):
+        """
+        Returns a dict of name -> array.array holding every landmark tree,
+        for restore().
+        """
+        state = {'root': array('i', self.landmarks())}
+        for name in ('dist', 'parent', 'first'):
+            values = array(getattr(ShortestPathTree(0, 0), name).typecode)
+            for tree in self._landmarks:
+                values.extend(getattr(tree, name))
+            state[name] = values
+        return state
+
+    def restore(self, state):
+        """
+        Replaces the landmarks with those of a state() dict, whose values
+        may be any sequences, such as NumPy arrays.
+        """
+        size = self._map.number_of_nodes()
+        self._landmarks = []
+        for i, root in enumerate(state['root']):
+            tree = ShortestPathTree(int(root), 0)
+            for name in ('dist', 'parent', 'first'):
+                values = getattr(tree, name)
+                values.fromstring(state[name][i * size:(i + 1) * size].tostring())
+            self._landmarks.append(tree)
+
+    def path(self, source, target):
+        """
+        Returns the list of nodes from source to target, or None if target
+        is unreachable.
+        """
+        neighbours = self._map.neighbours
+        positions = self._map.get_positions()
+        scale = self._scale
+        tx, ty = positions[target]
+        #landmarks that reach target, with their distance to it
+        bounds = [(tree.dist, tree.dist[target]) for tree in self._landmarks
+                  if tree.dist[target] < INFINITY]
+
+        def estimate(n):
+            x, y = positions[n]
+            h = hypot(x - tx, y - ty) * scale
+            for dist, to_target in bounds:
+                h = max(h, abs(to_target - dist[n]))
+            return h
+
+        best = {source: 0.0}
+        parent = {source: NO_NODE}
+        settled = set()
+        heap = [(estimate(source), 0.0, source)]
+        while heap:
+            f, d, n = heappop(heap)
+            if n in settled:
+                continue
+            if n == target:
+                path = [n]
+                while parent[n] != NO_NODE:
+                    n = parent[n]
+                    path.append(n)
+                path.reverse()
+                return path
+            settled.add(n)
+            for m, weight in neighbours(n):
+                new_dist = d + weight
+                if new_dist < best.get(m, INFINITY):
+                    best[m] = new_dist
+                    parent[m] = n
+                    heappush(heap, (new_dist + estimate(m), new_dist, m))
+        return None
+
+    def edge_changed(self, n1, n2, old_weight, new_weight):
+        """
+        Repairs the landmark trees the new weight of edge n1-n2 affects.
+        """
+        neighbours = self._map.neighbours
+        for tree in self._landmarks:
+            if tree.affected_by(n1, n2, old_weight, new_weight):
+                tree.repair(n1, n2, old_weight, new_weight, neighbours)
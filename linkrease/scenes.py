@@ -13,6 +13,8 @@
 #You should have received a copy of the GNU General Public License
 #along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
 
+from threading import Thread
+
 import pyglet
 
 import cocos
@@ -21,12 +23,25 @@ from cocos.scenes import *
 from cocos.director import director
 
 import settings
-import levels
-import layers
 
 from multiplayer import current_player
 
 
+def prefetch_level():
+    """
+    Loads the model modules and starts generating the next level, all in
+    a background thread, so the intro or menu showing does not wait.
+    """
+    thread = Thread(target=_prefetch_level)
+    thread.daemon = True
+    thread.start()
+
+
+def _prefetch_level():
+    import levels
+    levels.prefetch_random_level()
+
+
 class IntroScene(cocos.scene.Scene):
     def __init__(self):
         super(IntroScene, self).__init__()
@@ -75,6 +90,10 @@ class MenuScene(cocos.scene.Scene):
         self.add(self.bg_layer)
         self.add(MainMenu())
 
+        #the next level is made here rather than during a game, where it
+        #would take time from the game loop
+        prefetch_level()
+
 
 class MainMenu(cocos.menu.Menu):
     def __init__(self, title='LINKREASE'):
@@ -107,8 +126,14 @@ class MainMenu(cocos.menu.Menu):
 class GameLayerController(cocos.layer.scrolling.ScrollingManager):
     is_event_handler = True
 
-    def __init__(self, map):
+    def __init__(self, map, simulation=None):
+        """
+        simulation: what to send input to and advance each frame, such as a
+            network.GameClient; defaults to a local Simulation of map
+        """
         super(GameLayerController, self).__init__()
+        import layers
+        from simulation import Simulation
         self.scale = settings.ZOOM_MIN
 
         #store model
@@ -120,30 +145,37 @@ class GameLayerController(cocos.layer.scrolling.ScrollingManager):
 
         #add callback to model
         self.map.add_listener(self.on_model_change)
-        self.map.add_fleet_listener(self.on_fleet_launched)
+
+        #routes are dragged from owned nodes, so have those ready
+        self.owned = set()
+        self.precompute_owned(self.map.nodes_iter())
+
+        #input is applied and the model advanced in fixed ticks
+        self.simulation = simulation or Simulation(map)
+        self.dragging = False
+        self.schedule(self.update_simulation)
 
     def on_mouse_press(self, x, y, buttons, modifiers):
         px, py = self.map_view.map_from_pixel(*self.pixel_from_screen(x, y))
         n = self.map.closest_node_to(px, py)
         player = current_player()
         if self.map.get_owner(n) is player:
-            self.map.select_node(player, n)
+            self.simulation.command('select_node', player, n)
+            self.dragging = True
 
     def on_mouse_release(self, x, y, buttons, modifiers):
-        player = current_player()
-        source = self.map.selected_node(player)
-        target = self.map.targeted_node(player)
-        if source is not None and source is not target:
+        if self.dragging:
             player = current_player()
-            self.map.move_units_to_target(player)
-        self.map.select_node(player, None)
+            self.simulation.command('move_units_to_target', player)
+            self.simulation.command('select_node', player, None)
+            self.dragging = False
 
     def on_mouse_drag(self, x, y, dx, dy, buttons, modifiers):
-        player = current_player()
-        if self.map.selected_node(player) is not None:
+        if self.dragging:
+            player = current_player()
             px, py = self.map_view.map_from_pixel(*self.pixel_from_screen(x, y))
             n = self.map.closest_node_to(px, py)
-            self.map.target_node(player, n)
+            self.simulation.command('target_node', player, n)
 
     def on_mouse_scroll(self, x, y, dx, dy):
         """
@@ -169,29 +201,39 @@ class GameLayerController(cocos.layer.scrolling.ScrollingManager):
             #set centre point
             self.set_focus(px, py)
 
-    def on_model_change(self):
-        self.map_view.on_model_change()
+    def precompute_owned(self, nodes):
+        """
+        Builds the routing rows of any of nodes the player has just taken,
+        in the background.
+        """
+        nodes = list(nodes)
+        player = current_player()
+        owned = set(n for n in nodes if self.map.get_owner(n) is player)
+        new = owned - self.owned
+        self.owned = (self.owned - set(nodes)) | owned
+        if new:
+            self.map.precompute_routes(sorted(new), background=True)
 
-    def on_fleet_launched(self, fleet):
-        fleet.add_arrival_listener(self.on_fleet_arrived)
-        self.schedule(fleet.step_time)
+    def on_model_change(self, changes):
+        self.map_view.on_model_change(changes)
+        self.precompute_owned(changes.nodes)
 
-    def on_fleet_arrived(self, fleet):
-        self.map.deploy(fleet.get_target(), fleet.get_num_units(), fleet.get_owner())
-        self.unschedule(fleet.step_time)
+    def update_simulation(self, dt, *args, **kwargs):
+        self.simulation.update(dt)
 
 
 class GameScene(cocos.scene.Scene):
-    def __init__(self, graph=None, player_start=[0]):
+    def __init__(self, graph=None, player_start=[0], simulation=None):
         super(GameScene, self).__init__()
 
         if graph:
             self.G = graph
         else:
-            self.G = levels.generate_random_level()
+            import levels
+            self.G = levels.next_random_level()
 
         #add scrolling manager
-        self.game_layer_controller = GameLayerController(self.G)
+        self.game_layer_controller = GameLayerController(self.G, simulation)
         self.add(self.game_layer_controller)
 
         #add base_layer
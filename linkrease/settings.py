@@ -13,8 +13,7 @@
 #You should have received a copy of the GNU General Public License
 #along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
 
-from pyglet import image
-
+import os
 
 SKIP_INTRO = False
 ADD_RANDOM_CREASES = True
@@ -36,8 +35,25 @@ ZOOM_MIN = 0.5
 ZOOM_MAX = 2.0
 ZOOM_STEP = 0.1
 
+LINK_RENDERER = 'lines'  # 'lines': one vertex list, 'sprites': one sprite per link
+LINK_WIDTH = 2.0
+FLEET_RENDERER = 'quads'  # 'quads': one vertex list, 'sprites': one sprite per fleet
+
+CULL_MARGIN = 32.0  # pixels kept beyond the view, beyond the longest link
+LOD_SCALE = 0.75  # zoom below which large maps are drawn in low detail
+LOD_MIN_NODES = 500  # visible nodes needed before low detail is used
+LOD_FLEET_CELL = 24.0  # pixels per merged fleet marker in low detail
+
+LEVEL_SEED = None  # seed of every new game's level, None for a new layout each time
+LEVEL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.linkrease', 'levels')
+LEVEL_CACHE_BYTES = 64 * 1024 * 1024  # oldest cached levels are deleted beyond this
+
 PLAYER = ['NEUTRAL', 'player1', 'player2']
 
+NETWORK_PORT = 7290  # port a network game is served on by default
+INPUT_DELAY = 2  # ticks between giving a command and a lockstep game applying it
+ROLLBACK_TICKS = 30  # ticks a lockstep game may run ahead of its slowest peer
+
 COLOUR_DATA = {
                'intro': {
                           'background': (255, 255, 255, 255),
@@ -75,13 +91,13 @@ COLOUR_DATA = {
                         },
                }
 
-IMAGE_DATA = {
-              'node': image.load('node.png'),
-              'factory': image.load('factory.png'),
-              'link': image.load('link.png'),
-              'crease': image.load('crease.png'),
-              'unit': image.load('unit.png'),
-              }
+IMAGE_FILES = {
+               'node': 'node.png',
+               'factory': 'factory.png',
+               'link': 'link.png',
+               'crease': 'crease.png',
+               'unit': 'unit.png',
+               }
 
 UNIT_SPEED = {  # per second
               'link': 0.06,
@@ -89,3 +105,16 @@ UNIT_SPEED = {  # per second
              }
 
 UNIT_SPEED['ratio'] = UNIT_SPEED['link'] / UNIT_SPEED['crease']
+
+TICK_RATE = 30  # simulation ticks per second of game time
+MAX_TICKS_PER_UPDATE = 5  # ticks run per frame at most, dropping the rest
+HEADLESS_STEP = 1.0 / 60  # seconds of game time per headless tick
+
+#fleets closer than this on the same edge, with the same owner and target,
+#merge into one (same units as link weights)
+FLEET_MERGE_DISTANCE = 0.005
+
+#maps with at least LANDMARK_MIN_NODES nodes precompute LANDMARKS shortest
+#path trees to guide A* route searches
+LANDMARKS = 8
+LANDMARK_MIN_NODES = 5000
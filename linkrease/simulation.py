@@ -0,0 +1,119 @@
+#This file is part of linkrease.
+
+#linkrease is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#linkrease is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
+
+import settings
+
+#Map methods that can be queued as commands
+COMMANDS = ('select_node', 'target_node', 'move_units_to_target')
+
+
+def encode_command(name, args):
+    """
+    Returns (command index, node) for sending a command over the wire.
+
+    args: the arguments after the player; node is -1 if there is none
+    """
+    if name not in COMMANDS:
+        raise ValueError("unknown command: %s" % name)
+    node = args[0] if args and args[0] is not None else -1
+    return COMMANDS.index(name), node
+
+
+def decode_command(command, node, nodes=None):
+    """
+    Returns (name, args) from the result of encode_command(), with args
+    the arguments after the player.
+
+    nodes: number of nodes of the map, to check node against
+    Raises ValueError if command is unknown or node is not on the map.
+    """
+    if not 0 <= command < len(COMMANDS):
+        raise ValueError("unknown command: %d" % command)
+    if nodes is not None and node >= nodes:
+        raise ValueError("no node %d on a map of %d" % (node, nodes))
+    name = COMMANDS[command]
+    if name == 'move_units_to_target':
+        return name, ()
+    return name, (None if node < 0 else node,)
+
+
+class Simulation(object):
+    """
+    Advances a Map in fixed ticks, however long frames take.
+
+    Player input is queued as commands and applied at the start of the next
+    tick, so the same commands on the same map always give the same game.
+    Each tick sends a single change event.
+    """
+    def __init__(self, map, rate=settings.TICK_RATE):
+        """
+        rate: ticks per second of game time
+        """
+        self.map = map
+        self.dt = 1.0 / rate
+        self.tick = 0
+        self._accumulator = 0.0
+        self._commands = []
+        self._listeners = []
+
+    def add_tick_listener(self, callback):
+        """
+        callback(tick, commands) is called after each tick, with the list
+        of (name, args) commands applied in it.
+        """
+        self._listeners.append(callback)
+
+    def command(self, name, *args):
+        """
+        Queues a call of the Map method name for the next tick.
+        """
+        if name not in COMMANDS:
+            raise ValueError("unknown command: %s" % name)
+        self._commands.append((name, args))
+
+    def step(self):
+        """
+        Runs one tick: applies queued commands, then moves fleets and
+        resolves arrivals. Returns the fleets that arrived.
+        """
+        commands = self._commands
+        self._commands = []
+        self.map.get_fleet_engine().save_positions()
+        with self.map.batch():
+            for name, args in commands:
+                getattr(self.map, name)(*args)
+            arrived = self.map.advance(self.dt)
+        self.tick += 1
+        [callback(self.tick, commands) for callback in self._listeners]
+        return arrived
+
+    def update(self, dt):
+        """
+        Runs as many ticks as dt seconds of real time cover, at most
+        settings.MAX_TICKS_PER_UPDATE, and carries the rest over.
+
+        Returns how far, from 0 to 1, rendering is into the next tick.
+        """
+        self._accumulator += dt
+        ticks = 0
+        while self._accumulator >= self.dt and ticks < settings.MAX_TICKS_PER_UPDATE:
+            self.step()
+            self._accumulator -= self.dt
+            ticks += 1
+        #fall behind rather than spend ever longer catching up
+        self._accumulator = min(self._accumulator, self.dt)
+        alpha = self._accumulator / self.dt
+        self.map.get_fleet_engine().alpha = alpha
+        return alpha
@@ -0,0 +1,307 @@
+#This file is part of linkrease.
+
+#linkrease is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#linkrease is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Binary snapshots of a Map, with the commands given after it for replays.
+
+A file is a header, a table of contents and the raw bytes of a set of
+named arrays, each starting on an 8 byte boundary:
+
+    header: magic, version, tick, tick rate, number of arrays
+    table: per array its name, NumPy dtype, byte offset and length
+
+Arrays are read out of a memory map of the file, without parsing any
+text. Loading a Map copies each graph column once, in one go, and builds
+Fleet views only when they are asked for.
+"""
+
+import mmap
+import struct
+
+import numpy as np
+
+import fleets
+import graph
+import models
+import settings
+import simulation
+
+MAGIC = 'LNKR'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHHIdI')
+ENTRY = struct.Struct('<16s4sQQ')
+ALIGN = 8
+
+#graph arrays that change during a game
+COLUMNS = ('owner', 'garrison', 'factory', 'creased', 'highlight', 'weight')
+
+#commands are stored as four columns, one row per command
+COMMAND_DTYPES = (
+    ('tick', np.uint32),
+    ('command', np.uint8),
+    ('player', np.uint8),
+    ('node', np.int32),
+)
+
+
+def map_arrays(map, selections=True):
+    """
+    Returns a dict of name -> NumPy array holding the whole state of map.
+
+    selections: False leaves out the nodes players selected and targeted,
+        and the routes highlighted between them
+    """
+    players = settings.PLAYER
+    arrays = dict([('graph.' + name, graph.as_numpy(values))
+                   for name, values in map.get_graph().arrays().items()])
+    if not selections:
+        arrays['graph.highlight'] = np.zeros_like(arrays['graph.highlight'])
+    arrays['positions'] = np.array(map.get_positions(), dtype=np.float64).reshape(-1, 2)
+    for name, values in map.get_fleet_engine().state().items():
+        arrays['fleet.' + name] = values
+    for name, values in map.get_route_finder().state().items():
+        arrays['landmarks.' + name] = np.frombuffer(values, dtype=graph.NUMPY_TYPES[values.typecode])
+    for name, getter in (('selected', map.selected_node), ('targeted', map.targeted_node)):
+        nodes = [getter(p) if selections else None for p in players]
+        arrays[name] = np.array([-1 if n is None else n for n in nodes], dtype=np.int32)
+    return arrays
+
+
+def map_from_arrays(arrays):
+    """
+    Builds the Map described by a dict of arrays from map_arrays().
+    """
+    players = settings.PLAYER
+    compact = graph.CompactGraph.from_arrays(
+        arrays['positions'].reshape(-1, 2),
+        dict([(name, arrays['graph.' + name]) for name in graph.ARRAYS]))
+    map = models.Map(compact, fresh=False)
+    map.get_fleet_engine().restore(dict([(name, arrays['fleet.' + name])
+                                         for name in fleets.STATE + ('prev',)]))
+    map.get_route_finder().restore(dict([(name, arrays['landmarks.' + name])
+                                         for name in ('root', 'dist', 'parent', 'first')]))
+    for p, selected, targeted in zip(players, arrays['selected'], arrays['targeted']):
+        map.select_node(p, None if selected < 0 else int(selected), set_target=False)
+        map.target_node(p, None if targeted < 0 else int(targeted), force=True)
+    map.dirty('nodes')
+    map.dirty('links')
+    map.dirty('units')
+    return map
+
+
+def capture(map):
+    """
+    Returns a copy of everything about map that changes during a game, for
+    restore(). Cheaper than map_arrays(), as fixed arrays are left out.
+    """
+    compact = map.get_graph()
+    state = dict([('graph.' + name, np.array(graph.as_numpy(getattr(compact, name))))
+                  for name in COLUMNS])
+    for name, values in map.get_fleet_engine().state().items():
+        state['fleet.' + name] = np.array(values)
+    players = settings.PLAYER
+    for name, getter in (('selected', map.selected_node), ('targeted', map.targeted_node)):
+        nodes = [getter(p) for p in players]
+        state[name] = np.array([-1 if n is None else n for n in nodes], dtype=np.int32)
+    return state
+
+
+def restore(map, state):
+    """
+    Puts map back as it was when state was captured, in place, and sends
+    one change event for everything that differs.
+
+    Edge weights are set one by one, so cached routes are repaired rather
+    than rebuilt. Fleets in flight are all replaced: the old ones arrive,
+    and fleet listeners hear of every restored one as if just launched.
+    """
+    compact = map.get_graph()
+    players = settings.PLAYER
+    with map.batch():
+        changed = np.zeros(compact.number_of_nodes(), dtype=np.bool_)
+        for name in ('owner', 'garrison', 'factory'):
+            changed |= graph.as_numpy(getattr(compact, name)) != state['graph.' + name]
+        for n in np.flatnonzero(changed).tolist():
+            map.set_owner(n, players[state['graph.owner'][n]], no_event=True)
+            map.set_garrison(n, int(state['graph.garrison'][n]), no_event=True)
+            map.set_factory(n, bool(state['graph.factory'][n]), no_event=True)
+        for name, setter in (('creased', map.set_creased), ('highlight', map.set_highlight)):
+            values = state['graph.' + name]
+            for e in np.flatnonzero(graph.as_numpy(getattr(compact, name)) != values).tolist():
+                setter(compact.edge_u[e], compact.edge_v[e], bool(values[e]), no_event=True)
+        weight = state['graph.weight']
+        for e in np.flatnonzero(graph.as_numpy(compact.weight) != weight).tolist():
+            map.set_weight(compact.edge_u[e], compact.edge_v[e], float(weight[e]))
+
+        engine = map.get_fleet_engine()
+        engine.restore(dict([(name, state['fleet.' + name])
+                             for name in fleets.STATE + ('prev',)]))
+        for p, selected, targeted in zip(players, state['selected'], state['targeted']):
+            map.select_node(p, None if selected < 0 else int(selected), set_target=False)
+            map.target_node(p, None if targeted < 0 else int(targeted), force=True)
+        map.notify_listeners()
+    for fleet in engine.fleets():
+        map.notify_fleet_listeners(fleet)
+
+
+def command_arrays(commands):
+    """
+    Returns the columns of a list of (tick, name, args) commands.
+    """
+    columns = [[] for name, dtype in COMMAND_DTYPES]
+    for tick, name, args in commands:
+        command, node = simulation.encode_command(name, args[1:])
+        row = (tick, command, settings.PLAYER.index(args[0]), node)
+        [column.append(value) for column, value in zip(columns, row)]
+    return dict([('commands.' + name, np.array(column, dtype=dtype))
+                 for column, (name, dtype) in zip(columns, COMMAND_DTYPES)])
+
+
+def commands_from_arrays(arrays):
+    """
+    Returns the list of (tick, name, args) commands held in arrays.
+    """
+    columns = [arrays['commands.' + name].tolist() for name, dtype in COMMAND_DTYPES]
+    commands = []
+    for tick, command, player, node in zip(*columns):
+        name, args = simulation.decode_command(command, node)
+        commands.append((tick, name, (settings.PLAYER[player],) + args))
+    return commands
+
+
+def dumps(map, tick=0, rate=settings.TICK_RATE, commands=(), selections=True):
+    """
+    Returns map, as it is at the start of tick, and the (tick, name, args)
+    commands given from then on, in the snapshot format.
+
+    selections: as for map_arrays()
+    """
+    arrays = map_arrays(map, selections)
+    arrays.update(command_arrays(commands))
+    names = sorted(arrays)
+
+    offset = HEADER.size + ENTRY.size * len(names)
+    entries = []
+    for name in names:
+        values = np.ascontiguousarray(arrays[name])
+        offset += -offset % ALIGN
+        entries.append((name, values, offset))
+        offset += values.nbytes
+
+    parts = [HEADER.pack(MAGIC, VERSION, 0, tick, rate, len(names))]
+    parts.extend(ENTRY.pack(name, values.dtype.str, offset, values.size)
+                 for name, values, offset in entries)
+    end = HEADER.size + ENTRY.size * len(names)
+    for name, values, offset in entries:
+        parts.append('\0' * (offset - end))
+        parts.append(values.tostring())
+        end = offset + values.nbytes
+    return ''.join(parts)
+
+
+def write(path, map, tick=0, rate=settings.TICK_RATE, commands=()):
+    """
+    Saves dumps(map, tick, rate, commands) to path.
+    """
+    with open(path, 'wb') as f:
+        f.write(dumps(map, tick, rate, commands))
+
+
+def parse(data, name='snapshot'):
+    """
+    Returns (tick, rate, arrays) from a buffer holding a snapshot.
+
+    The arrays are read only views onto data. Raises ValueError if data is
+    not a snapshot this version can read.
+    """
+    try:
+        magic, version, flags, tick, rate, count = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("not a linkrease snapshot: %s" % name)
+        if version != VERSION:
+            raise ValueError("unsupported snapshot version %d: %s" % (version, name))
+        entries = [ENTRY.unpack_from(data, HEADER.size + ENTRY.size * i)
+                   for i in xrange(count)]
+    except struct.error:
+        raise ValueError("truncated snapshot: %s" % name)
+    arrays = {}
+    for name, dtype, offset, size in entries:
+        name = name.rstrip('\0')
+        arrays[name] = np.frombuffer(data, dtype=dtype.rstrip('\0'), count=size, offset=offset)
+    return tick, rate, arrays
+
+
+def read_arrays(path):
+    """
+    Returns (tick, rate, arrays) from a file made by write().
+
+    The arrays are read only views onto a memory map of the file. Raises
+    ValueError if the file is not a snapshot this version can read.
+    """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return parse(data, path)
+
+
+def loads(data):
+    """
+    Returns (map, tick, rate, commands) from a string made by dumps().
+    """
+    tick, rate, arrays = parse(data)
+    return map_from_arrays(arrays), tick, rate, commands_from_arrays(arrays)
+
+
+def read(path):
+    """
+    Returns (map, tick, rate, commands) from a file made by write().
+    """
+    tick, rate, arrays = read_arrays(path)
+    return map_from_arrays(arrays), tick, rate, commands_from_arrays(arrays)
+
+
+class Recorder(object):
+    """
+    Keeps every command a Simulation applies, for write().
+    """
+    def __init__(self, simulation):
+        self.start = simulation.tick
+        self.commands = []
+        simulation.add_tick_listener(self.on_tick)
+
+    def on_tick(self, tick, commands):
+        self.commands.extend((tick, name, args) for name, args in commands)
+
+
+def replay(map, tick, rate, commands, until=None):
+    """
+    Replays commands on map from tick, as fast as possible, and returns
+    the Simulation left at the last tick run.
+
+    until: tick to stop at, defaults to the tick of the last command
+    """
+    sim = simulation.Simulation(map, rate)
+    sim.tick = tick
+    if until is None:
+        until = max([t for t, name, args in commands] or [tick])
+    pending = sorted(commands, key=lambda command: command[0])
+    pending.reverse()
+    while sim.tick < until:
+        #commands applied in tick t were queued before it ran
+        while pending and pending[-1][0] <= sim.tick + 1:
+            t, name, args = pending.pop()
+            sim.command(name, *args)
+        sim.step()
+    return sim
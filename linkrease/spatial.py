@@ -0,0 +1,119 @@
+#This file is part of linkrease.
+
+#linkrease is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#linkrease is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with linkrease.  If not, see <http://www.gnu.org/licenses/>.
+
+from math import sqrt
+
+import numpy as np
+
+
+class SpatialGrid(object):
+    """
+    Uniform grid of buckets over node positions.
+
+    Answers nearest node and nodes-in-rectangle queries while only looking
+    at the buckets around the query instead of every node.
+    """
+    def __init__(self, positions, cells=None):
+        """
+        positions: sequence of (x, y), indexed by node
+        cells: buckets per axis, defaults to about one node per bucket
+        """
+        if cells is None:
+            cells = int(sqrt(len(positions))) or 1
+        self._cells = cells
+
+        xy = np.array(positions, dtype=np.float64).reshape(-1, 2)
+        if len(xy):
+            self._x0, self._y0 = xy.min(axis=0).tolist()
+            width, height = (xy.max(axis=0) - (self._x0, self._y0)).tolist()
+        else:
+            self._x0 = self._y0 = 0.0
+            width = height = 1.0
+        self._cell_w = (width or 1.0) / cells
+        self._cell_h = (height or 1.0) / cells
+
+        #same cells as _cell(), for every node at once
+        last = cells - 1
+        i = np.clip(((xy[:, 0] - self._x0) / self._cell_w).astype(np.int64), 0, last)
+        j = np.clip(((xy[:, 1] - self._y0) / self._cell_h).astype(np.int64), 0, last)
+        bucket = i * cells + j
+        #stable, so each bucket keeps its nodes in order
+        order = np.argsort(bucket, kind='mergesort')
+        entries = zip(order.tolist(), xy[order, 0].tolist(), xy[order, 1].tolist())
+        ends = np.cumsum(np.bincount(bucket, minlength=cells * cells)).tolist()
+        self._buckets = [entries[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+    def _cell(self, x, y):
+        """
+        Returns the bucket coordinates of a point, clamped to the grid.
+        """
+        last = self._cells - 1
+        i = int((x - self._x0) / self._cell_w)
+        j = int((y - self._y0) / self._cell_h)
+        return (min(max(i, 0), last), min(max(j, 0), last))
+
+    def _ring(self, ci, cj, r):
+        """
+        Yields the buckets exactly r cells away from bucket (ci, cj).
+        """
+        cells = self._cells
+        buckets = self._buckets
+        for i in xrange(max(ci - r, 0), min(ci + r, cells - 1) + 1):
+            if abs(i - ci) == r:
+                js = xrange(max(cj - r, 0), min(cj + r, cells - 1) + 1)
+            else:
+                js = [j for j in (cj - r, cj + r) if 0 <= j < cells]
+            for j in js:
+                yield buckets[i * cells + j]
+
+    def nearest(self, x, y, exclude=None):
+        """
+        Returns the node closest to (x, y), or None if there are no nodes.
+
+        Nodes for which exclude(node) is true are skipped.
+        """
+        ci, cj = self._cell(x, y)
+        step = min(self._cell_w, self._cell_h)
+        best = None
+        best_dist = None
+        for r in xrange(self._cells):
+            for bucket in self._ring(ci, cj, r):
+                for n, nx, ny in bucket:
+                    if exclude is not None and exclude(n):
+                        continue
+                    dx = x - nx
+                    dy = y - ny
+                    dist = dx * dx + dy * dy
+                    if best is None or dist < best_dist:
+                        best_dist = dist
+                        best = n
+            #every bucket further out is at least r * step away
+            if best is not None and best_dist <= (r * step) ** 2:
+                break
+        return best
+
+    def in_rect(self, x0, y0, x1, y1):
+        """
+        Returns the nodes inside the rectangle from (x0, y0) to (x1, y1).
+        """
+        cells = self._cells
+        i0, j0 = self._cell(x0, y0)
+        i1, j1 = self._cell(x1, y1)
+        nodes = []
+        for i in xrange(i0, i1 + 1):
+            for j in xrange(j0, j1 + 1):
+                nodes.extend(n for n, nx, ny in self._buckets[i * cells + j]
+                             if x0 <= nx <= x1 and y0 <= ny <= y1)
+        return nodes